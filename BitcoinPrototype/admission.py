@@ -0,0 +1,121 @@
+# coding:utf-8
+"""
+Admission of the transactions relayed by peers.
+The socket handlers only push the raw transactions into a bounded queue.
+Worker threads take them off in batches, decode them and hand each batch
+to Mempool.add_many, which looks up the outputs they spend in one UTXO
+multi-get and checks every signature in one pass over the signature
+verifier, whose processes spread the work across the cores. When the
+queue is full the transaction is refused, and the peer is asked to send
+it again later.
+"""
+import logging
+import queue
+import threading
+
+from utils import Singleton
+from txpool import Mempool
+from assembler import BlockAssembler
+from codec import unpack_tx
+from conf import admission_queue_size, admission_workers, admission_batch_size
+
+log = logging.getLogger('kademlia')
+
+class AdmissionQueue(Singleton):
+    """Validates inbound transactions off the network threads
+    Attributes:
+        batch_size (int): Transactions validated and admitted at once.
+        received (int): Transactions queued.
+        refused (int): Transactions refused because the queue was full.
+        admitted (int): Transactions that reached the mempool.
+        rejected (int): Transactions dropped because they did not decode or
+            verify, or were already in the pool.
+    """
+    def __init__(self, max_size=admission_queue_size, workers=admission_workers,
+                 batch_size=admission_batch_size):
+        if hasattr(self, "_queue"):
+            return
+        self.batch_size = batch_size
+        self._queue = queue.Queue(max_size)
+        self._stats_lock = threading.Lock()
+        self.received = 0
+        self.refused = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='admission-%d' % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, tx_data):
+        """
+        Queue a packed transaction, False if the queue is full
+        """
+        try:
+            self._queue.put_nowait(tx_data)
+        except queue.Full:
+            with self._stats_lock:
+                self.refused += 1
+            return False
+        with self._stats_lock:
+            self.received += 1
+        return True
+
+    @property
+    def saturated(self):
+        return self._queue.full()
+
+    def _next_batch(self):
+        # block for the first one, then take what is already waiting
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.admit(batch)
+            except Exception as e:
+                log.info("admission failed: %s" % e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def admit(self, batch):
+        """
+        Validate a batch of packed transactions and admit the valid ones
+        """
+        txs = []
+        for tx_data in batch:
+            try:
+                txs.append(unpack_tx(tx_data))
+            except (ValueError, KeyError, TypeError) as e:
+                log.info("transaction rejected: %s" % e)
+        admitted = Mempool().add_many(txs) if txs else []
+        with self._stats_lock:
+            self.admitted += len(admitted)
+            self.rejected += len(batch) - len(admitted)
+        if admitted:
+            BlockAssembler().notify()
+        return admitted
+
+    def join(self):
+        """Wait until every queued transaction went through"""
+        self._queue.join()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queued": self._queue.qsize(),
+                "received": self.received,
+                "refused": self.refused,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
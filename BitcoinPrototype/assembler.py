@@ -0,0 +1,91 @@
+# coding:utf-8
+"""
+Block template assembly.
+Every path that admits transactions to the mempool calls
+BlockAssembler().notify(). A template is built and handed to the miner
+when the pending transactions reach a count or a size threshold, or when
+the oldest one has waited long enough, so small bursts are batched
+instead of mining one block per pair of payments. Nothing is built while
+the miner is busy, the assembler checks again whenever the tip moves.
+"""
+import threading
+import time
+
+from block_chain import BlockChain
+from miner import Miner
+from txpool import Mempool
+from utils import Singleton
+from conf import block_max_txs, block_max_bytes, block_trigger_txs, block_trigger_bytes, block_max_wait
+
+class BlockAssembler(Singleton):
+    """Decides when to mine and what goes in the block
+    Attributes:
+        max_txs (int): Transactions in a block, coinbase included.
+        max_bytes (int): Encoded size of the transactions in a block.
+        trigger_txs (int): Pending transactions that start a block at once.
+        trigger_bytes (int): Pending bytes that start a block at once.
+        max_wait (float): Seconds the oldest pending transaction may wait
+            before a block is started anyway.
+    """
+    def __init__(self, max_txs=block_max_txs, max_bytes=block_max_bytes,
+                 trigger_txs=block_trigger_txs, trigger_bytes=block_trigger_bytes,
+                 max_wait=block_max_wait):
+        if hasattr(self, "_thread"):
+            return
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.trigger_txs = trigger_txs
+        self.trigger_bytes = trigger_bytes
+        self.max_wait = max_wait
+        self.templates = 0
+        self._cond = threading.Condition()
+        self._miner = Miner()
+        # registered after the miner, which drops stale templates first
+        BlockChain.add_tip_listener(self.on_tip_changed)
+        self._thread = threading.Thread(target=self._timer, name='assembler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def build_template(self):
+        """
+        An unmined block with the best pending transactions that fit the budget
+        """
+        txs = Mempool().select(max_count=self.max_txs - 1, max_bytes=self.max_bytes)
+        return BlockChain().new_block_template(txs)
+
+    def notify(self):
+        """
+        Called after transactions are admitted, start a block if one is due
+        """
+        with self._cond:
+            if self._due():
+                self._miner.submit(self.build_template())
+                self.templates += 1
+            # the timer may have a closer deadline now
+            self._cond.notify()
+
+    def on_tip_changed(self, tip_hash):
+        self.notify()
+
+    def _due(self, now=None):
+        if self._miner.busy:
+            return False
+        mempool = Mempool()
+        oldest = mempool.oldest_time()
+        if oldest is None:
+            return False
+        if len(mempool) >= self.trigger_txs or mempool.bytes >= self.trigger_bytes:
+            return True
+        return (now or time.time()) - oldest >= self.max_wait
+
+    def _timer(self):
+        # wakes up when the oldest pending transaction has waited max_wait
+        while True:
+            with self._cond:
+                oldest = Mempool().oldest_time()
+                if oldest is None or self._miner.busy:
+                    timeout = self.max_wait
+                else:
+                    timeout = max(0.0, oldest + self.max_wait - time.time())
+                self._cond.wait(timeout)
+            self.notify()
@@ -0,0 +1,95 @@
+# coding:utf-8
+"""
+Micro benchmarks of the node's hot paths, run with python3 benchmark.py.
+The chains used here are synthetic, nothing touches the database.
+"""
+import json
+import os
+import time
+
+import crypto
+from block import Block
+from block_header import BlockHeader
+from transactions import TXInput, TXOutput, Transaction
+
+def _timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def _fake_tx(n_inputs):
+    vins = []
+    for index in range(n_inputs):
+        vin = TXInput(os.urandom(32).hex(), index, os.urandom(64).hex())
+        vin.signature = os.urandom(64).hex()
+        vins.append(vin)
+    vouts = [TXOutput(20, os.urandom(32).hex()), TXOutput(900, os.urandom(32).hex())]
+    tx = Transaction(vins, vouts)
+    tx.set_id()
+    return tx
+
+def fake_chain(n_blocks, n_inputs=20):
+    """Serialized blocks of a chain, one coinbase and one spend per block"""
+    docs = []
+    prev_hash = ''
+    for height in range(n_blocks):
+        coinbase = Transaction.coinbase_tx(os.urandom(32).hex(), str(time.time()))
+        block = Block.new_block(BlockHeader('', height, prev_hash),
+                                [coinbase, _fake_tx(n_inputs)])
+        block.block_header.nonce = 0
+        block.set_header_hash()
+        prev_hash = block.block_header.hash
+        docs.append(json.dumps(block.serialize()))
+    return docs
+
+def bench_chain_scan(n_blocks=200, n_inputs=20, repeat=5):
+    """
+    Load every block of a chain, with and without rebuilding the merkle tree
+    """
+    docs = fake_chain(n_blocks, n_inputs)
+
+    def rebuild():
+        for doc in docs:
+            block = Block.deserialize(json.loads(doc))
+            block.set_hash_merkle_root_hash(block.compute_merkle_root())
+
+    def trusted():
+        for doc in docs:
+            Block.deserialize(json.loads(doc))
+
+    rebuild_time = _timeit(rebuild, repeat)
+    trusted_time = _timeit(trusted, repeat)
+    print('chain scan, %d blocks x %d inputs' % (n_blocks, n_inputs))
+    print('\trebuild merkle root: %.2f ms' % (rebuild_time * 1000))
+    print('\ttrusted load:        %.2f ms (%.1fx)' % (trusted_time * 1000, rebuild_time / trusted_time))
+
+def bench_crypto(n=200):
+    """
+    Sign and verify with every crypto backend installed, and check they
+    all produce the same signatures
+    """
+    backends = []
+    for name in ('ecdsa', 'secp256k1'):
+        try:
+            backends.append(crypto.get_backend(name))
+        except ImportError:
+            print('crypto backend %s is not installed' % name)
+    private_key = backends[0].generate_private_key()
+    messages = [os.urandom(32).hex().encode() for _ in range(n)]
+    print('crypto, %d signatures' % n)
+    signatures = {}
+    for backend in backends:
+        public_key = backend.public_key(private_key)
+        sigs = []
+        sign_time = _timeit(lambda: sigs.extend(backend.sign(private_key, m) for m in messages), 1)
+        verify_time = _timeit(lambda: all(backend.verify(public_key, s, m)
+                                          for s, m in zip(sigs, messages)), 1)
+        signatures[backend.name] = sigs
+        print('\t%-10s sign %8.0f/s  verify %8.0f/s' % (backend.name, n / sign_time, n / verify_time))
+    if len(signatures) > 1:
+        print('\tsame signatures: %s' % (len(set(map(tuple, signatures.values()))) == 1))
+
+if __name__ == "__main__":
+    bench_chain_scan()
+    bench_crypto()
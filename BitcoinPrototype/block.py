@@ -1,10 +1,12 @@
 # coding:utf-8
 import json
+import time
 from pow import ProofOfWork
 from block_header import BlockHeader
 from transactions import Transaction
-from merkle import MerkleTree
+from merkle import MerkleTree, legacy_root_hash
 from errors import NonceNotFoundError, TransactionVerifyError
+from conf import max_future_block_time
 
 class Block(object):
     """A Block
@@ -15,37 +17,103 @@ class Block(object):
     """
     MAGIC_NO = 0xBCBCBCBC
     def __init__(self, block_header, transactions):
+        # Trusted load path, the header keeps the merkle root it came with.
+        # It is only checked by validate(). New blocks use new_block().
         self._magic_no = self.MAGIC_NO
         self._block_header = block_header
         self._transactions = transactions
+
+    @classmethod
+    def new_block(cls, block_header, transactions):
+        """
+        Build a new block and set the merkle root of its transactions
+        """
+        block = cls(block_header, transactions)
+        block.set_hash_merkle_root_hash(block.compute_merkle_root())
+        return block
+
+    def merkle_tree(self):
+        # the leaves are the encoded transactions the txids were hashed from
+        return MerkleTree(tx.raw_bytes() for tx in self._transactions)
+
+    def compute_merkle_root(self):
+        return self.merkle_tree().root_hash
+
+    def _legacy_merkle_root(self):
+        # blocks made before the canonical encoding hashed the JSON of each transaction
         data = []
         for tx in self._transactions:
             data.append(json.dumps(tx.serialize()))
-        merkle_tree = MerkleTree(data)
-        self.set_hash_merkle_root_hash(merkle_tree.root_hash)
+        return legacy_root_hash(data)
 
-    def mine(self, bc):
+    def check_merkle_root(self):
+        root = self._block_header.hash_merkle_root
+        return self.compute_merkle_root() == root or self._legacy_merkle_root() == root
+
+    def mine(self, bc, stop=None):
+        """
+        Find the nonce of the block, setting stop aborts the search
+        with MiningCancelledError.
+        """
         pow = ProofOfWork(self)
-        for tx in self._transactions:
-            if not bc.verify_transaction(tx):
-                raise TransactionVerifyError('transaction verify error')
+        if not bc.verify_transactions(self._transactions):
+            raise TransactionVerifyError('transaction verify error')
         try:
-            nonce, _ = pow.run()
+            nonce, _ = pow.run(stop)
         except NonceNotFoundError as e:
             print(e)
+            raise
         self._block_header.nonce = nonce
 
+    def check_bits(self, bc):
+        """
+        Check the block records the difficulty the retarget schedule asks for
+        """
+        bits = self._block_header.bits
+        prev_hash = self._block_header.prev_block_hash
+        prev = bc.get_block_by_hash(prev_hash) if prev_hash else None
+        if bits is None:
+            # blocks without difficulty only come before retargeting started
+            return prev is None or prev.block_header.bits is None
+        if prev is None:
+            return bits == ProofOfWork.INITIAL_BITS
+        return bits == bc.next_bits(prev)
+
+    def check_timestamp(self, bc, now=None):
+        """
+        Check the block is later than the median time of the blocks before
+        it and not too far ahead of the local clock, the retarget reads
+        these timestamps
+        """
+        timestamp = float(self._block_header.timestamp)
+        if timestamp > (now or time.time()) + max_future_block_time:
+            return False
+        prev_hash = self._block_header.prev_block_hash
+        prev = bc.get_block_by_hash(prev_hash) if prev_hash else None
+        if prev is None:
+            return True
+        return timestamp > bc.median_time_past(prev)
+
     def validate(self, bc):
+        # the merkle root is computed over the txids the block claims
+        if not all(tx.check_txid() for tx in self._transactions):
+            return False
+        if not self.check_merkle_root():
+            return False
+        if not self.check_timestamp(bc):
+            return False
+        if not self.check_bits(bc):
+            return False
         pow = ProofOfWork(self)
-        for tx in self._transactions:
-            if not bc.verify_transaction(tx):
-                raise TransactionVerifyError('transaction verify error')
+        if not bc.verify_transactions(self._transactions):
+            raise TransactionVerifyError('transaction verify error')
         return pow.validate()
     
     @classmethod
     def new_genesis_block(cls, coin_base_tx):
         block_header = BlockHeader.new_genesis_block_header()
-        return cls(block_header, coin_base_tx)
+        block_header.bits = ProofOfWork.INITIAL_BITS
+        return cls.new_block(block_header, coin_base_tx)
 
     @property
     def block_header(self):
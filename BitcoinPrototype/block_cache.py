@@ -0,0 +1,93 @@
+# coding:utf-8
+"""
+An in-memory LRU cache of deserialized blocks shared by every BlockChain.
+Blocks are keyed by hash and the heights of cached blocks are kept as
+aliases, so reads by height hit the cache too. The tip is cached as well,
+so the hot path of add_block never has to go to storage.
+"""
+import threading
+from collections import OrderedDict
+
+from utils import Singleton
+from conf import block_cache_size
+
+class BlockCache(Singleton):
+    """A LRU cache of Block objects
+    Attributes:
+        max_entries (int): How many blocks are kept before evicting.
+        tip (tuple): (hash, height) of the last block, None if unknown.
+        hits (int): Lookups answered from the cache.
+        misses (int): Lookups that had to go to storage.
+    """
+    def __init__(self, max_entries=block_cache_size):
+        if hasattr(self, '_blocks'):
+            return
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._blocks = OrderedDict()
+        self._heights = {}
+        self.tip = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, hash):
+        with self._lock:
+            block = self._blocks.get(hash)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(hash)
+            self.hits += 1
+            return block
+
+    def get_by_height(self, height):
+        with self._lock:
+            hash = self._heights.get(height)
+            if hash is None:
+                # not counted, the caller looks the block up by hash next
+                return None
+            return self.get(hash)
+
+    def put(self, block):
+        hash = block.block_header.hash
+        with self._lock:
+            self._blocks[hash] = block
+            self._blocks.move_to_end(hash)
+            self._heights[block.block_header.height] = hash
+            while len(self._blocks) > self.max_entries:
+                _, evicted = self._blocks.popitem(last=False)
+                self._drop_height(evicted)
+
+    def remove(self, hash):
+        with self._lock:
+            block = self._blocks.pop(hash, None)
+            if block is not None:
+                self._drop_height(block)
+            if self.tip and self.tip[0] == hash:
+                self.tip = None
+
+    def _drop_height(self, block):
+        height = block.block_header.height
+        if self._heights.get(height) == block.block_header.hash:
+            del self._heights[height]
+
+    def set_tip(self, hash, height):
+        with self._lock:
+            self.tip = (hash, height)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._heights.clear()
+            self.tip = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._blocks),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
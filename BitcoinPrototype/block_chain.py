@@ -1,87 +1,203 @@
 # coding:utf-8
+import threading
 import time
 from block import Block
+from block_cache import BlockCache
+from codec import pack_block, unpack_block
 from block_header import BlockHeader
+from pow import ProofOfWork
 from db import DB
 from transactions import TXInput, TXOutput, Transaction
-from errors import NotEnoughAmountError
+from errors import NotEnoughAmountError, TransactionVerifyError
 from utils import address_to_pubkey_hash
 from wallets import Wallets
 from utxo import UTXOSet
-from conf import db_url
+from sigverify import SignatureVerifier
+from sigcache import SignatureCache
+from txpool import Mempool
+from conf import db_url, median_time_span
 
 class BlockChain(object):
+    # Key prefix of the height -> hash index
+    HEIGHT_FLAG = 'H'
+    # Key prefix of the txid -> (block, position) index
+    TX_FLAG = 'T'
+    # Called with the new tip hash whenever the tip moves
+    _tip_listeners = []
+    # Held by every tip change, the miner and peer threads both move it
+    _chain_lock = threading.RLock()
     def __init__(self, db_url=db_url):
         self.db = DB(db_url)
+        self.cache = BlockCache()
 
     def new_genesis_block(self, transaction):
         if 'l' not in self.db:
             transactions = [transaction]
             genesis_block = Block.new_genesis_block(transactions)
             genesis_block.set_header_hash()
-            self.db.create(genesis_block.block_header.hash, genesis_block.serialize())
-            self.set_last_hash(genesis_block.block_header.hash)
+            self._connect_block(genesis_block)
 
-            utxo = UTXOSet()
-            utxo.update(genesis_block)
-
-    def get_last_block(self):
+    def _get_tip(self):
+        """
+        (hash, height) of the last block, None for an empty chain
+        """
+        if self.cache.tip:
+            return self.cache.tip
         last_block_hash_doc = self.db.get('l')
         if not last_block_hash_doc:
             return None
         last_block_hash = last_block_hash_doc.get('hash', '')
-        block_data = self.db.get(last_block_hash)
-        block = Block.deserialize(block_data)
-        return block
-
-    def set_last_hash(self, hash):
-        last_hash = {"hash": str(hash)}
-        if 'l' not in self.db:
-            self.db['l'] = last_hash
+        if 'height' in last_block_hash_doc:
+            height = last_block_hash_doc['height']
         else:
-            last_block_hash_doc = self.db.get('l')
-            last_block_hash_doc.update(hash=hash)
-            self.db.update([last_block_hash_doc])
+            height = self.get_block_by_hash(last_block_hash).block_header.height
+        self.cache.set_tip(last_block_hash, height)
+        return self.cache.tip
+
+    def get_last_block(self):
+        tip = self._get_tip()
+        if not tip:
+            return None
+        return self.get_block_by_hash(tip[0])
+
+    def get_last_height(self):
+        tip = self._get_tip()
+        if not tip:
+            return -1
+        return tip[1]
+
+    def _height_key(self, height):
+        return '%s%010d' % (self.HEIGHT_FLAG, height)
+
+    def _tx_key(self, txid):
+        return self.TX_FLAG + txid
+
+    def _index_docs(self, block):
+        hash = block.block_header.hash
+        height = block.block_header.height
+        docs = {self._height_key(height): {"hash": hash}}
+        for index, tx in enumerate(block.transactions):
+            docs[self._tx_key(tx.txid)] = {"block": hash, "height": height, "index": index}
+        return docs
+
+    def _save_block(self, block):
+        """
+        Store the block, its index entries and the new tip in one batch
+        """
+        hash = block.block_header.hash
+        puts = self._index_docs(block)
+        puts[hash] = pack_block(block)
+        puts['l'] = {"hash": hash, "height": block.block_header.height}
+        self.db.write_batch(puts=puts)
+        self.cache.put(block)
+        self.cache.set_tip(hash, block.block_header.height)
+
+    @classmethod
+    def add_tip_listener(cls, listener):
+        cls._tip_listeners.append(listener)
+
+    def _notify_tip(self, hash):
+        for listener in self._tip_listeners:
+            listener(hash)
+
+    def _connect_block(self, block):
+        """
+        Store the block, apply it to the UTXO set and move the tip
+        """
+        with self._chain_lock:
+            self._save_block(block)
+            UTXOSet().update(block)
+            Mempool().remove_for_block(block)
+            self._notify_tip(block.block_header.hash)
+
+    def build_indexes(self):
+        """
+        Build the height and transaction indexes of a chain stored
+        before they existed, walking back from the tip once.
+        """
+        last_block_hash_doc = self.db.get('l')
+        if not last_block_hash_doc or 'height' in last_block_hash_doc:
+            return
+        puts = {}
+        block = self.get_last_block()
+        puts['l'] = {"hash": block.block_header.hash, "height": block.block_header.height}
+        while block:
+            puts.update(self._index_docs(block))
+            if not block.block_header.prev_block_hash:
+                break
+            block = self.get_block_by_hash(block.block_header.prev_block_hash)
+        self.db.write_batch(puts=puts)
+
+    def get_block_hash_by_height(self, height):
+        # peers ask for any height, only the chain's ones reach storage
+        if height < 0 or height > self.get_last_height():
+            return None
+        index_doc = self.db.get(self._height_key(height))
+        if index_doc:
+            return index_doc['hash']
+        # Chains stored before the height index existed are indexed once
+        self.build_indexes()
+        index_doc = self.db.get(self._height_key(height))
+        return index_doc['hash'] if index_doc else None
 
     def get_block_by_height(self, height):
         """
         Get a block by height
         """
-        query = {"selector": {"block_header": {"height": height}}}
-        docs = self.db.find(query)
-        block = None
-        for doc in docs:
-            block = Block.deserialize(doc)
-        return block
+        block = self.cache.get_by_height(height)
+        if block:
+            return block
+        hash = self.get_block_hash_by_height(height)
+        if not hash:
+            return None
+        return self.get_block_by_hash(hash)
 
     def roll_back(self):
-        last_block = self.get_last_block()
-        last_height = last_block.block_header.height
-        block_doc = self.db.get(last_block.block_header.hash)
-        try:
-            self.db.delete(block_doc)
-        except ResourceNotFound as e:
-            print(e)
-        block = self.get_block_by_height(last_height-1)
-        self.set_last_hash(block.block_header.hash)
+        with self._chain_lock:
+            last_block = self.get_last_block()
+            last_height = last_block.block_header.height
+            prev_hash = last_block.block_header.prev_block_hash
+            deletes = list(self._index_docs(last_block).keys())
+            deletes.append(last_block.block_header.hash)
+            self.db.write_batch(
+                puts={'l': {"hash": prev_hash, "height": last_height-1}},
+                deletes=deletes)
+            self.cache.remove(last_block.block_header.hash)
+            self.cache.set_tip(prev_hash, last_height-1)
+            Mempool().readd_block(last_block)
+            self._notify_tip(prev_hash)
 
     def get_block_by_hash(self, hash):
         """
         Get a block by hash
         """
+        block = self.cache.get(hash)
+        if block:
+            return block
         block_data = self.db.get(hash)
-        block = Block(None, None)
-        block.deserialize(block_data)
+        if not block_data:
+            return None
+        block = unpack_block(block_data)
+        self.cache.put(block)
         return block
 
     def add_block(self, transactions):
         """
-        add a block to block_chain
+        add a block to block_chain, mining it in the calling thread
+        """
+        block = self.new_block_template(transactions)
+        block.mine(self)
+        block.set_header_hash()
+        self._connect_block(block)
+
+    def new_block_template(self, transactions):
+        """
+        Build an unmined block on top of the tip, with a coinbase reward
         """
         last_block = self.get_last_block()
         prev_hash = last_block.get_header_hash()
         height = last_block.block_header.height + 1
-        block_header = BlockHeader('', height, prev_hash)
+        block_header = BlockHeader('', height, prev_hash, self.next_bits(last_block))
 
          # reward to wallets[0]
         wallets = Wallets()
@@ -94,44 +210,77 @@ class BlockChain(object):
         utxo_set = UTXOSet()
         txs = utxo_set.clear_transactions(transactions)
 
-        block = Block(block_header, txs)
-        block.mine(self)
-        block.set_header_hash()
-        self.db.create(block.block_header.hash, block.serialize())
-        last_hash = block.block_header.hash
-        self.set_last_hash(last_hash)
+        return Block.new_block(block_header, txs)
+
+    def next_bits(self, prev_block):
+        """
+        Difficulty of the block following prev_block
+        """
+        height = prev_block.block_header.height + 1
+        window = ProofOfWork.RETARGET_WINDOW
+        timespan = None
+        if height % window == 0 and height >= window:
+            first_block = self.get_block_by_height(height - window)
+            timespan = float(prev_block.block_header.timestamp) - float(first_block.block_header.timestamp)
+        return ProofOfWork.next_bits(height, prev_block.block_header.bits, timespan)
+
+    def median_time_past(self, block):
+        """
+        Median timestamp of block and the median_time_span - 1 blocks
+        before it
+        """
+        timestamps = []
+        while block and len(timestamps) < median_time_span:
+            timestamps.append(float(block.block_header.timestamp))
+            prev_hash = block.block_header.prev_block_hash
+            block = self.get_block_by_hash(prev_hash) if prev_hash else None
+        timestamps.sort()
+        return timestamps[len(timestamps) // 2]
+
+    def add_mined_block(self, block):
+        """
+        Connect a block mined from a template, unless the tip moved meanwhile
+        """
+        with self._chain_lock:
+            if block.block_header.prev_block_hash != self.get_last_block().block_header.hash:
+                return False
+            self._connect_block(block)
+            return True
+
+    def _validate_peer_block(self, block):
+        try:
+            return block.validate(self)
+        except (TransactionVerifyError, ValueError):
+            return False
 
-        utxo_set.update(block)
-    
     def add_block_from_peers(self, block):
-        last_block = self.get_last_block()
-        utxo = UTXOSet()
-        if last_block:
-            prev_hash = last_block.get_header_hash()
-            last_height = last_block.block_header.height
-            if block.block_header.height < last_height:
-                raise ValueError('block height is error')
-            if not block.validate(self):
-                raise ValueError('block is not valid')
-            if block.block_header.height == last_height and block != last_block:
-                utxo.roll_back(last_block)
-                self.roll_back()
-            if block.block_header.height == last_height+1 and block.block_header.prev_block_hash == last_block.block_header.hash:
-                self.db.create(block.block_header.hash, block.serialize())
-                last_hash = block.block_header.hash
-                self.set_last_hash(last_hash)
-                utxo.update(block)
-        else:
-            self.db.create(block.block_header.hash, block.serialize())
-            last_hash = block.block_header.hash
-            self.set_last_hash(last_hash)
-            utxo.update(block)
+        with self._chain_lock:
+            last_block = self.get_last_block()
+            utxo = UTXOSet()
+            if last_block:
+                last_height = last_block.block_header.height
+                if block.block_header.height < last_height:
+                    raise ValueError('block height is error')
+                if block.block_header.height == last_height and block != last_block:
+                    if block.block_header.prev_block_hash != last_block.block_header.prev_block_hash:
+                        raise ValueError('block is not on this chain')
+                    # The block replaces the tip. Its inputs are checked against
+                    # the UTXO set without the tip, the tip comes back if it fails.
+                    utxo.roll_back(last_block)
+                    self.roll_back()
+                    if not self._validate_peer_block(block):
+                        self._connect_block(last_block)
+                        raise ValueError('block is not valid')
+                    self._connect_block(block)
+                elif block.block_header.height == last_height+1 and block.block_header.prev_block_hash == last_block.block_header.hash:
+                    if not self._validate_peer_block(block):
+                        raise ValueError('block is not valid')
+                    self._connect_block(block)
+            else:
+                self._connect_block(block)
     
     def __getitem__(self, index):
-        last_block = self.get_last_block()
-        height = -1
-        if last_block:
-            height = last_block.block_header.height
+        height = self.get_last_height()
         if index <= height:
             return self.get_block_by_height(index)
         else:
@@ -149,7 +298,9 @@ class BlockChain(object):
         Find spendable outputs
         """
         uxto_set = UTXOSet()
-        accumulated, spentable_outs = uxto_set.find_spendable_outputs(address, amount)
+        # outputs already spent by a pending transaction are not offered again
+        accumulated, spentable_outs = uxto_set.find_spendable_outputs(
+            address, amount, exclude=Mempool().spent_outpoints())
         return accumulated, spentable_outs
 
     def find_UTXO(self):
@@ -159,11 +310,7 @@ class BlockChain(object):
         spent_txos = {}
         unspent_txs = {}
         
-        last_block = self.get_last_block()
-        if last_block:
-            last_height = last_block.block_header.height
-        else:
-            last_height = -1
+        last_height = self.get_last_height()
         if last_height == -1:
             return unspent_txs
         # Reverse
@@ -223,32 +370,120 @@ class BlockChain(object):
         tx = Transaction.coinbase_tx(to_addr, data)
         return tx
 
+    def find_transaction_position(self, txid):
+        """
+        Return (block hash, height, index in block) of a transaction
+        """
+        index_doc = self.db.get(self._tx_key(txid))
+        if not index_doc:
+            return None
+        return index_doc['block'], index_doc['height'], index_doc['index']
+
     def find_transaction(self, txid):
-        # TODO try use mongo_query
-        last_block = self.get_last_block()
-        last_height = last_block.block_header.height
-        # Reverse
-        for height in range(last_height, -1, -1):
-            block = self.get_block_by_height(height)
-            for tx in block.transactions:
-                if tx.txid == txid:
-                    return tx
-        return None
+        position = self.find_transaction_position(txid)
+        if not position:
+            return None
+        block = self.get_block_by_hash(position[0])
+        if not block:
+            return None
+        return block.transactions[position[2]]
 
-    def sign_transaction(self, tx, priv_key):
-        prev_txs = {}
-        for vin in tx.vins:
-            prev_tx = self.find_transaction(vin.txid)
-            if not prev_tx:
+    def transaction_proof(self, txid):
+        """
+        What a light client needs to check that a transaction is in a block
+        with merkle.verify_proof(tx.raw_bytes(), proof, merkle_root)
+        """
+        position = self.find_transaction_position(txid)
+        if not position:
+            return None
+        hash, height, index = position
+        block = self.get_block_by_hash(hash)
+        return {
+            "block": hash,
+            "height": height,
+            "index": index,
+            "merkle_root": block.block_header.hash_merkle_root,
+            "proof": block.merkle_tree().proof(index),
+        }
+
+    def find_transactions(self, txids):
+        """
+        Find several transactions at once, returns a dict of txid -> tx
+        """
+        index_docs = self.db.get_many([self._tx_key(txid) for txid in set(txids)])
+        blocks = {}
+        missing = []
+        for hash in set(doc['block'] for doc in index_docs.values()):
+            block = self.cache.get(hash)
+            if block:
+                blocks[hash] = block
+            else:
+                missing.append(hash)
+        for hash, block_data in self.db.get_many(missing).items():
+            block = unpack_block(block_data)
+            self.cache.put(block)
+            blocks[hash] = block
+        txs = {}
+        for doc in index_docs.values():
+            block = blocks.get(doc['block'])
+            if not block:
                 continue
-            prev_txs[prev_tx.txid] = prev_tx
-        tx.sign(priv_key, prev_txs)
+            tx = block.transactions[doc['index']]
+            txs[tx.txid] = tx
+        return txs
+
+    def sign_transaction(self, tx, priv_key):
+        prev_outputs = UTXOSet().get_outputs([(vin.txid, vin.vout) for vin in tx.vins])
+        tx.sign(priv_key, prev_outputs)
 
     def verify_transaction(self, tx):
-        prev_txs = {}
-        for vin in tx.vins:
-            prev_tx = self.find_transaction(vin.txid)
-            if not prev_tx:
-                continue
-            prev_txs[prev_tx.txid] = prev_tx
-        return tx.verify(prev_txs)
\ No newline at end of file
+        """
+        Check the signatures of tx against the outputs it spends.
+        An input whose output is not in the UTXO set is spent already
+        or never existed, the transaction is then invalid.
+        """
+        if tx.is_coinbase():
+            return True
+        outpoints = [(vin.txid, vin.vout) for vin in tx.vins]
+        prev_outputs = UTXOSet().get_outputs(outpoints)
+        if len(set(outpoints)) != len(outpoints) or len(prev_outputs) != len(outpoints):
+            return False
+        return tx.verify(prev_outputs)
+
+    def verify_transactions(self, txs):
+        """
+        Verify the signatures of several transactions, e.g. a block's,
+        in one pass over the signature verifier. The spent outputs are
+        fetched from the UTXO set in one multi-get, a transaction may also
+        spend the outputs of one before it. An output missing or spent
+        twice makes the whole batch invalid.
+        """
+        txs = list(txs)
+        outpoints = [(vin.txid, vin.vout) for tx in txs if not tx.is_coinbase()
+                     for vin in tx.vins]
+        if not outpoints:
+            return True
+        utxo_outputs = UTXOSet().get_outputs(outpoints)
+        created = {}
+        spent = set()
+        checks = []
+        for tx in txs:
+            if not tx.is_coinbase():
+                prev_outputs = {}
+                for vin in tx.vins:
+                    outpoint = (vin.txid, vin.vout)
+                    output = created.get(outpoint) or utxo_outputs.get(outpoint)
+                    if output is None or outpoint in spent:
+                        return False
+                    spent.add(outpoint)
+                    prev_outputs[outpoint] = output
+                checks.extend(tx.signature_checks(prev_outputs))
+            for index, vout in enumerate(tx.vouts):
+                created[(tx.txid, index)] = vout
+        # signatures already seen in the pool or an earlier block are skipped
+        cache = SignatureCache()
+        checks = cache.missing(checks)
+        if not SignatureVerifier.get().verify(checks):
+            return False
+        cache.add_many(checks)
+        return True
\ No newline at end of file
@@ -12,14 +12,17 @@ class BlockHeader(object):
         hash_merkle_root(str): Hash of the merkle_root.
         height (int): Height of Block
         nonce (int): A 32 bit arbitrary random number that is typically used once.
+        bits (int): Compact encoding of the target the hash must stay below,
+            None for blocks mined before difficulty retargeting.
     """
-    def __init__(self, hash_merkle_root, height, pre_block_hash=''):
+    def __init__(self, hash_merkle_root, height, pre_block_hash='', bits=None):
         self.timestamp = str(time.time())
         self.prev_block_hash = pre_block_hash
         self.hash = None
         self.hash_merkle_root = hash_merkle_root
         self.height = height
         self.nonce = None
+        self.bits = bits
     
     @classmethod
     def new_genesis_block_header(cls):
@@ -36,6 +39,7 @@ class BlockHeader(object):
                      str(self.prev_block_hash),
                      str(self.hash_merkle_root),
                      str(self.height),
+                     '' if self.bits is None else str(self.bits),
                      str(self.nonce)]
         data = ''.join(data_list)
         self.hash = sum256_hex(data)
@@ -51,12 +55,13 @@ class BlockHeader(object):
         hash_merkle_root = data.get('hash_merkle_root', '')
         height = data.get('height', '')
         nonce = data.get('nonce', '')
-        block_header = cls(hash_merkle_root, height, prev_block_hash)
+        bits = data.get('bits')
+        block_header = cls(hash_merkle_root, height, prev_block_hash, bits)
         block_header.timestamp = timestamp
         block_header.nonce = nonce
         block_header.hash = hash
         return block_header
 
     def __repr__(self):
-        return 'BlockHeader(timestamp={0!r}, hash_merkle_root={1!r}, prev_block_hash={2!r}, hash={3!r}, nonce={4!r}, height={5!r})'.format(
-            self.timestamp, self.hash_merkle_root, self.prev_block_hash, self.hash, self.nonce, self.height)
\ No newline at end of file
+        return 'BlockHeader(timestamp={0!r}, hash_merkle_root={1!r}, prev_block_hash={2!r}, hash={3!r}, nonce={4!r}, height={5!r}, bits={6!r})'.format(
+            self.timestamp, self.hash_merkle_root, self.prev_block_hash, self.hash, self.nonce, self.height, self.bits)
\ No newline at end of file
@@ -5,7 +5,10 @@ from block_chain import BlockChain
 from wallet import Wallet
 from wallets import Wallets
 from utxo import UTXOSet
-from txpool import TxPool
+from txpool import Mempool
+from miner import Miner
+from assembler import BlockAssembler
+from admission import AdmissionQueue
 from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.client import ServerProxy
 from network import P2p, PeerServer, TCPServer
@@ -103,14 +106,13 @@ class Cli(object):
         bc = BlockChain()
         tx = bc.new_transaction(from_addr, to_addr, amount)
         #bc.add_block([tx])
-        tx_pool = TxPool()
-        tx_pool.add(tx)
+        mempool = Mempool()
+        mempool.add(tx)
         try:
             server = PeerServer()
             server.broadcast_tx(tx)
-            if tx_pool.is_full():
-                bc.add_block(tx_pool.txs)
-                tx_pool.clear()
+            # the pool keeps the transactions until a block confirms them
+            BlockAssembler().notify()
         except Exception as e:
             pass
         print('send %d from %s to %s' %(amount, from_addr, to_addr))
@@ -147,9 +149,22 @@ def add_block(self, data):
 
 def start():
     bc = BlockChain()
+    bc.build_indexes()
     utxo_set = UTXOSet()
     utxo_set.reindex(bc)
 
+    # the transactions pending when the node stopped
+    mempool = Mempool()
+    mempool.load()
+    mempool.start_snapshots()
+
+    miner = Miner()
+    miner.add_callback(bc.add_mined_block)
+    # mines the pending transactions once there are enough of them
+    BlockAssembler()
+    # validates the transactions relayed by peers
+    AdmissionQueue()
+
     tcpserver = TCPServer()
     tcpserver.listen()
     tcpserver.run()
@@ -0,0 +1,301 @@
+# coding:utf-8
+"""
+Compact binary encoding of blocks and transactions.
+Hashes are carried as raw 32 bytes, integers as varints and the header
+has a fixed layout. Every record starts with a version byte, and records
+written to a stream are prefixed with their length.
+
+Block:
+    version(1) prev_block_hash(32) hash_merkle_root(32) hash(32)
+    height(u32) nonce(u64) bits(u32) timestamp(str) tx_count(varint) txs
+    Version 1 blocks have no bits field.
+Transaction:
+    version(1) txid(32)
+    vin_count(varint) [txid(32) vout(zigzag varint) pub_key(str)]...
+    vout_count(varint) [value(varint) pub_key_hash(str)]...
+    [signature(str)]... one per input
+The signatures come last so the signed-over part stays contiguous.
+The canonical bytes a txid is the sha256 of are the same record without
+the txid and the signatures, this layout must not change without a new
+version.
+
+Strings are tagged: lowercase hex is stored as its raw bytes, anything else
+(coinbase data, addresses) as utf-8.
+
+pack_block/unpack_block and pack_tx/unpack_tx turn objects into the value
+stored in the database or sent to peers, following conf.codec. The unpack
+side accepts both encodings, so nodes and databases can mix them.
+"""
+import base64
+import struct
+
+from block import Block
+from block_header import BlockHeader
+from transactions import TXInput, TXOutput, Transaction
+from conf import codec
+
+VERSION = 1
+BLOCK_VERSION = 2
+
+_EMPTY_HASH = b'\0' * 32
+_NO_NONCE = 0xFFFFFFFFFFFFFFFF
+# a zero target is never valid, it stands for a header without bits
+_NO_BITS = 0
+
+_TAG_HEX = 0
+_TAG_TEXT = 1
+_TAG_NONE = 2
+
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+
+def varint(n):
+    if n < 0:
+        raise ValueError('varint must not be negative: %d' % n)
+    if n < 0x80:
+        return bytes((n,))
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _hash_bytes(hex_hash):
+    if not hex_hash:
+        return _EMPTY_HASH
+    raw = bytes.fromhex(hex_hash)
+    if len(raw) != 32:
+        raise ValueError('hash must be 32 bytes: %r' % hex_hash)
+    return raw
+
+def _read_hash(data, pos):
+    end = pos + 32
+    raw = data[pos:end]
+    if raw == _EMPTY_HASH:
+        return '', end
+    if len(raw) != 32:
+        raise ValueError('unexpected end of data')
+    return raw.hex(), end
+
+def _str_bytes(s):
+    if s is None:
+        return bytes((_TAG_NONE,))
+    try:
+        raw = bytes.fromhex(s)
+        tag = _TAG_HEX if raw.hex() == s else _TAG_TEXT
+    except ValueError:
+        tag = _TAG_TEXT
+    if tag == _TAG_TEXT:
+        raw = s.encode('utf-8')
+    return bytes((tag,)) + varint(len(raw)) + raw
+
+def _read_str(data, pos):
+    tag = data[pos]
+    if tag == _TAG_NONE:
+        return None, pos + 1
+    size = data[pos+1]
+    if size < 0x80:
+        pos += 2
+    else:
+        size, pos = read_varint(data, pos + 1)
+    raw = data[pos:pos+size]
+    if len(raw) != size:
+        raise ValueError('unexpected end of data')
+    if tag == _TAG_HEX:
+        return raw.hex(), pos + size
+    if tag == _TAG_TEXT:
+        return raw.decode('utf-8'), pos + size
+    raise ValueError('unknown string tag %d' % tag)
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def _unzigzag(n):
+    return n // 2 if not n & 1 else -(n + 1) // 2
+
+def encode_tx_id(tx):
+    out = [bytes((VERSION,)), varint(len(tx.vins))]
+    for vin in tx.vins:
+        out.append(_hash_bytes(vin.txid))
+        out.append(varint(_zigzag(vin.vout)))
+        out.append(_str_bytes(vin.pub_key))
+    out.append(varint(len(tx.vouts)))
+    for vout in tx.vouts:
+        out.append(varint(vout.value))
+        out.append(_str_bytes(vout.pub_key_hash))
+    return b''.join(out)
+
+def _encode_tx(tx):
+    # the canonical bytes with the txid after the version and the signatures appended
+    id_bytes = tx.id_bytes()
+    out = [id_bytes[:1], _hash_bytes(tx.txid), id_bytes[1:]]
+    for vin in tx.vins:
+        out.append(_str_bytes(vin.signature))
+    return b''.join(out)
+
+def _parse_tx(data, pos):
+    start = pos
+    if data[pos] != VERSION:
+        raise ValueError('unknown transaction version %d' % data[pos])
+    txid, pos = _read_hash(data, pos + 1)
+    body = pos
+    count, pos = read_varint(data, pos)
+    vins = []
+    for _ in range(count):
+        vin_txid, pos = _read_hash(data, pos)
+        vout = data[pos]
+        if vout < 0x80:
+            pos += 1
+        else:
+            vout, pos = read_varint(data, pos)
+        pub_key, pos = _read_str(data, pos)
+        vins.append(TXInput(vin_txid, _unzigzag(vout), pub_key))
+    count, pos = read_varint(data, pos)
+    vouts = []
+    for _ in range(count):
+        value, pos = read_varint(data, pos)
+        pub_key_hash, pos = _read_str(data, pos)
+        vouts.append(TXOutput(value, pub_key_hash))
+    body_end = pos
+    for vin in vins:
+        vin.signature, pos = _read_str(data, pos)
+    tx = Transaction(vins, vouts)
+    tx.txid = txid
+    # relaying or hashing the transaction again reuses the bytes it came in
+    tx._cache_encoding(bytes(data[start:start+1]) + bytes(data[body:body_end]),
+                       bytes(data[start:pos]))
+    return tx, pos
+
+def _block_parts(block, out):
+    header = block.block_header
+    out.append(bytes((BLOCK_VERSION,)))
+    out.append(_hash_bytes(header.prev_block_hash))
+    out.append(_hash_bytes(header.hash_merkle_root))
+    out.append(_hash_bytes(header.hash))
+    out.append(_U32.pack(header.height))
+    out.append(_U64.pack(_NO_NONCE if header.nonce is None else header.nonce))
+    out.append(_U32.pack(_NO_BITS if header.bits is None else header.bits))
+    out.append(_str_bytes(header.timestamp))
+    out.append(varint(len(block.transactions)))
+    for tx in block.transactions:
+        out.append(tx.raw_bytes())
+
+def _parse_block(data, pos):
+    version = data[pos]
+    if version not in (1, BLOCK_VERSION):
+        raise ValueError('unknown block version %d' % version)
+    prev_block_hash, pos = _read_hash(data, pos + 1)
+    hash_merkle_root, pos = _read_hash(data, pos)
+    hash, pos = _read_hash(data, pos)
+    height = _U32.unpack_from(data, pos)[0]
+    nonce = _U64.unpack_from(data, pos + 4)[0]
+    header = BlockHeader(hash_merkle_root, height, prev_block_hash)
+    header.hash = hash
+    header.nonce = None if nonce == _NO_NONCE else nonce
+    pos += 12
+    if version >= 2:
+        bits = _U32.unpack_from(data, pos)[0]
+        header.bits = None if bits == _NO_BITS else bits
+        pos += 4
+    header.timestamp, pos = _read_str(data, pos)
+    count, pos = read_varint(data, pos)
+    txs = []
+    for _ in range(count):
+        tx, pos = _parse_tx(data, pos)
+        txs.append(tx)
+    return Block(header, txs), pos
+
+def encode_tx(tx):
+    return tx.raw_bytes()
+
+def decode_tx(data):
+    try:
+        return _parse_tx(data, 0)[0]
+    except (IndexError, struct.error):
+        raise ValueError('unexpected end of data')
+
+def encode_block(block):
+    out = []
+    _block_parts(block, out)
+    return b''.join(out)
+
+def decode_block(data):
+    try:
+        return _parse_block(data, 0)[0]
+    except (IndexError, struct.error):
+        raise ValueError('unexpected end of data')
+
+# Streams carry length prefixed records
+
+def _write_record(stream, payload):
+    stream.write(varint(len(payload)))
+    stream.write(payload)
+
+def _read_record(stream):
+    n = 0
+    shift = 0
+    while True:
+        b = stream.read(1)
+        if not b:
+            return None if shift == 0 else _truncated()
+        n |= (b[0] & 0x7F) << shift
+        if b[0] < 0x80:
+            break
+        shift += 7
+    payload = stream.read(n)
+    if len(payload) != n:
+        _truncated()
+    return payload
+
+def _truncated():
+    raise ValueError('unexpected end of data')
+
+def write_tx(stream, tx):
+    _write_record(stream, encode_tx(tx))
+
+def read_tx(stream):
+    """Read the next transaction, None at the end of the stream"""
+    payload = _read_record(stream)
+    return None if payload is None else decode_tx(payload)
+
+def write_block(stream, block):
+    _write_record(stream, encode_block(block))
+
+def read_block(stream):
+    """Read the next block, None at the end of the stream"""
+    payload = _read_record(stream)
+    return None if payload is None else decode_block(payload)
+
+# Values stored in the database and sent to peers
+
+def pack_block(block, codec=codec):
+    if codec == 'binary':
+        return {"codec": "binary", "raw": base64.b64encode(encode_block(block)).decode()}
+    return block.serialize()
+
+def unpack_block(data):
+    if data.get("codec") == "binary":
+        return decode_block(base64.b64decode(data["raw"]))
+    return Block.deserialize(data)
+
+def pack_tx(tx, codec=codec):
+    if codec == 'binary':
+        return {"codec": "binary", "raw": base64.b64encode(encode_tx(tx)).decode()}
+    return tx.serialize()
+
+def unpack_tx(data):
+    if data.get("codec") == "binary":
+        return decode_tx(base64.b64decode(data["raw"]))
+    return Transaction.deserialize(data)
@@ -0,0 +1,44 @@
+# coding:utf-8
+import contextlib
+import io
+import os
+
+import pytest
+
+import conf
+
+@pytest.fixture(scope="session")
+def chain(tmp_path_factory):
+    path = tmp_path_factory.mktemp("chain")
+    cwd = os.getcwd()
+    os.chdir(str(path))
+    conf.db_engine = "sqlite"
+    from db import DB
+    db = DB(conf.db_url, engine="sqlite", path=str(path / "chain.db"))
+    from wallet import Wallet
+    from wallets import Wallets
+    from block_chain import BlockChain
+    wallet = Wallet.generate_wallet()
+    wallets = Wallets()
+    wallets[wallet.address] = wallet
+    wallets.save()
+    bc = BlockChain()
+    with contextlib.redirect_stdout(io.StringIO()):
+        bc.new_genesis_block(bc.coin_base_tx(wallet.address))
+        for _ in range(3):
+            bc.add_block([])
+    yield db, bc
+    os.chdir(cwd)
+
+@pytest.fixture
+def address(chain):
+    from wallets import Wallets
+    return next(iter(Wallets().items()))[0]
+
+@pytest.fixture
+def mempool(chain):
+    from txpool import Mempool
+    mempool = Mempool()
+    mempool.clear()
+    yield mempool
+    mempool.clear()
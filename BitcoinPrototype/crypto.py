@@ -0,0 +1,153 @@
+# coding:utf-8
+"""
+Elliptic curve operations on secp256k1 behind one small interface.
+The native libsecp256k1 binding (coincurve) is used when it is installed,
+the pure Python ecdsa package otherwise. Both backends produce the same
+bytes:
+    private key: 32 bytes
+    public key: 64 bytes, x || y
+    signature: 64 bytes, r || s, with the low s form
+Messages are hashed with sha1, the ecdsa package's default, and the nonce
+is derived from the key and the digest as RFC 6979 describes with
+HMAC-SHA256, which is what libsecp256k1 does. Signatures made before the
+backends existed used a random nonce and may have a high s, every backend
+accepts them.
+"""
+import hashlib
+import functools
+
+from conf import crypto_backend
+
+# Order of the secp256k1 group
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+
+def _digest(message):
+    return hashlib.sha1(message).digest()
+
+def _split(signature):
+    if len(signature) != 64:
+        raise ValueError('signature must be 64 bytes')
+    return int.from_bytes(signature[:32], 'big'), int.from_bytes(signature[32:], 'big')
+
+def _join(r, s):
+    if s > N // 2:
+        s = N - s
+    return r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+
+class EcdsaBackend(object):
+    """Pure Python, always available."""
+    name = 'ecdsa'
+
+    def __init__(self):
+        import ecdsa
+        self._ecdsa = ecdsa
+        self._signing_key = functools.lru_cache(maxsize=64)(self._parse_signing_key)
+        self._verifying_key = functools.lru_cache(maxsize=1024)(self._parse_verifying_key)
+
+    def _parse_signing_key(self, private_key):
+        return self._ecdsa.SigningKey.from_string(private_key, curve=self._ecdsa.SECP256k1)
+
+    def _parse_verifying_key(self, public_key):
+        return self._ecdsa.VerifyingKey.from_string(public_key, curve=self._ecdsa.SECP256k1)
+
+    def generate_private_key(self):
+        return self._ecdsa.SigningKey.generate(curve=self._ecdsa.SECP256k1).to_string()
+
+    def public_key(self, private_key):
+        return self._signing_key(private_key).get_verifying_key().to_string()
+
+    def sign(self, private_key, message):
+        r, s = self._signing_key(private_key).sign_digest_deterministic(
+            _digest(message), hashfunc=hashlib.sha256,
+            sigencode=lambda r, s, order: (r, s))
+        return _join(r, s)
+
+    def verify(self, public_key, signature, message):
+        if len(signature) != 64:
+            return False
+        try:
+            return bool(self._verifying_key(public_key).verify_digest(signature, _digest(message)))
+        except self._ecdsa.BadSignatureError:
+            return False
+
+class Secp256k1Backend(object):
+    """libsecp256k1 through the coincurve binding."""
+    name = 'secp256k1'
+
+    def __init__(self):
+        import coincurve
+        self._coincurve = coincurve
+        self._public_key = functools.lru_cache(maxsize=1024)(self._parse_public_key)
+
+    def _parse_public_key(self, public_key):
+        return self._coincurve.PublicKey(b'\x04' + public_key)
+
+    def generate_private_key(self):
+        return self._coincurve.PrivateKey().secret
+
+    def public_key(self, private_key):
+        return self._coincurve.PublicKey.from_secret(private_key).format(compressed=False)[1:]
+
+    @staticmethod
+    def _msg32(message):
+        # the sha1 digest as a 256 bit integer, the value ecdsa signs
+        return _digest(message).rjust(32, b'\0')
+
+    def sign(self, private_key, message):
+        der = self._coincurve.PrivateKey(private_key).sign(self._msg32(message), hasher=None)
+        return _join(*_der_decode(der))
+
+    def verify(self, public_key, signature, message):
+        # libsecp256k1 only accepts the low s form, older signatures may not use it
+        r, s = _split(signature)
+        if not 0 < r < N or not 0 < s < N:
+            return False
+        der = _der_encode(r, min(s, N - s))
+        return self._public_key(public_key).verify(der, self._msg32(message), hasher=None)
+
+def _der_int(n):
+    raw = n.to_bytes((n.bit_length() + 8) // 8, 'big')
+    return b'\x02' + bytes((len(raw),)) + raw
+
+def _der_encode(r, s):
+    body = _der_int(r) + _der_int(s)
+    return b'\x30' + bytes((len(body),)) + body
+
+def _der_decode(der):
+    pos = 2
+    values = []
+    for _ in range(2):
+        size = der[pos+1]
+        values.append(int.from_bytes(der[pos+2:pos+2+size], 'big'))
+        pos += 2 + size
+    return values
+
+_BACKENDS = {
+    'secp256k1': Secp256k1Backend,
+    'ecdsa': EcdsaBackend,
+}
+
+def get_backend(name=crypto_backend):
+    """
+    Build the backend called name, 'auto' picks the fastest one installed
+    """
+    if name != 'auto':
+        return _BACKENDS[name]()
+    try:
+        return Secp256k1Backend()
+    except ImportError:
+        return EcdsaBackend()
+
+backend = get_backend()
+
+def generate_private_key():
+    return backend.generate_private_key()
+
+def public_key(private_key):
+    return backend.public_key(private_key)
+
+def sign(private_key, message):
+    return backend.sign(private_key, message)
+
+def verify(public_key, signature, message):
+    return backend.verify(public_key, signature, message)
@@ -1,35 +1,58 @@
 # coding:utf-8
-import couchdb
 from utils import Singleton
+from storage import open_engine
+from conf import db_engine, db_path
 
 class DB(Singleton):
-    def __init__(self, db_server_url, db_name='block_chain'):
+    """Document store shared by the block chain and the UTXO set.
+    The storage engine is picked by conf.db_engine, see storage.py.
+    """
+    def __init__(self, db_server_url, db_name='block_chain', engine=db_engine, path=db_path):
+        if hasattr(self, '_engine'):
+            return
         self._db_server_url = db_server_url
-        self._server = couchdb.Server(self._db_server_url)
         self._db_name = db_name
-        self._db = None
-    
+        self._engine = open_engine(engine, db_server_url, db_name, path)
+
     @property
-    def db(self):
-        if not self._db:
-            try:
-                self._db = self._server[self._db_name]
-            except couchdb.ResourceNotFound:
-                self._db = self._server.create(self._db_name)
-        return self._db
+    def engine(self):
+        return self._engine
+
+    def get(self, key, default=None):
+        return self._engine.get(key, default)
+
+    def get_many(self, keys):
+        return self._engine.get_many(keys)
 
     def create(self, id, data):
-        self.db[id] = data
-        return id
+        return self._engine.create(id, data)
+
+    def put(self, id, data):
+        return self._engine.put(id, data)
+
+    def delete(self, id):
+        self._engine.delete(id)
+
+    def scan(self, prefix='', start=None, end=None):
+        return self._engine.scan(prefix, start, end)
+
+    def write_batch(self, puts=None, deletes=None):
+        self._engine.write_batch(puts, deletes)
+
+    def find(self, query):
+        return self._engine.find(query)
+
+    def close(self):
+        self._engine.close()
 
-    def __getattr__(self, name):
-        return getattr(self.db, name)
-    
     def __contains__(self, name):
-        return self.db.__contains__(name)
+        return self._engine.contains(name)
 
     def __getitem__(self, key):
-        return self.db[key]
+        doc = self._engine.get(key)
+        if doc is None:
+            raise KeyError(key)
+        return doc
 
     def __setitem__(self, key, value):
-        self.db[key] = value
\ No newline at end of file
+        self._engine.put(key, value)
@@ -7,4 +7,16 @@ class NotEnoughAmountError(Exception):
     pass
 
 class TransactionVerifyError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class MiningCancelledError(Exception):
+    pass
+
+class TransactionRejectedError(Exception):
+    pass
+
+class DocumentConflictError(Exception):
+    pass
+
+class DocumentNotFoundError(Exception):
+    pass
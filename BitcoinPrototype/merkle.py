@@ -1,48 +1,128 @@
 # coding:utf-8
+"""
+Merkle tree of the transactions of a block.
+Every level is one bytearray of raw 32 byte sha256 digests, level 0 holds
+the leaves and the last level the root. Leaves and inner nodes are hashed
+with a different prefix byte, so a node can never pass for a leaf, and a
+node without a sibling moves up unchanged instead of being paired with a
+copy of itself.
+"""
+import hashlib
 
-from utils import sum256_hex
+_LEAF = b'\x00'
+_NODE = b'\x01'
+_SIZE = 32
 
-class MerkleNode(object):
-    def __init__(self, left_node, right_node, data):
-        self.left = left_node   #the left node
-        self.right = right_node #the right node
-        #if there is no child, this node is in the bottom, so hash the data.
-        if not self.left and not self.right:
-            self.data = sum256_hex(data)
-        #else hash the hash data of the child, get the new data in this layer.
-        else:
-            data = self.left.data + self.right.data
-            self.data = sum256_hex(data)
+def _encode(data):
+    return data.encode() if isinstance(data, str) else data
+
+def hash_leaf(data):
+    return hashlib.sha256(_LEAF + _encode(data)).digest()
+
+def hash_node(left, right):
+    return hashlib.sha256(_NODE + left + right).digest()
 
 class MerkleTree(object):
-    def __init__(self, datas):
-        # if len(datas)%2 != 0:
-        #     datas.append(datas[-1])
-        
-        nodes = []
-
-        #At the begining, every txs is not the node before being hashed, so hash them and add their hash value as a node in the merkle tree.
-        for data_item in datas:
-            node = MerkleNode(None, None, data_item)
-            nodes.append(node)
-        #Then building the merkle tree.
-        for _ in range(len(datas)//2):#every time we built a layer, the amount of the data nodes in the next layer will //2.
-            new_level = []
-            for k in range(0, len(nodes), 2):
-                if k + 1 >= len(nodes):
-                    node = MerkleNode(nodes[k], "", None)
+    def __init__(self, datas=()):
+        leaves = bytearray()
+        for data in datas:
+            leaves += hash_leaf(data)
+        self._levels = [leaves]
+        self._build()
+
+    def _build(self):
+        # Batch construction, one pass per level
+        del self._levels[1:]
+        level = self._levels[0]
+        while len(level) > _SIZE:
+            view = memoryview(level)
+            parent = bytearray()
+            for pos in range(0, len(level), 2 * _SIZE):
+                if pos + _SIZE < len(level):
+                    parent += hash_node(view[pos:pos+_SIZE], view[pos+_SIZE:pos+2*_SIZE])
                 else:
-                    node = MerkleNode(nodes[k], nodes[k+1], None)
-                new_level.append(node)
-            nodes = new_level
-        
-        #At the end, the merkle_tree_root_hash is the root_node.
-        self.root_node = nodes[0]
+                    parent += view[pos:pos+_SIZE]
+            self._levels.append(parent)
+            level = parent
+
+    def __len__(self):
+        return len(self._levels[0]) // _SIZE
+
+    def append(self, data):
+        """
+        Add a leaf, only the nodes on its path to the root are hashed
+        """
+        index = len(self)
+        self._levels[0] += hash_leaf(data)
+        level = 0
+        while len(self._levels[level]) > _SIZE:
+            nodes = self._levels[level]
+            left = (index & ~1) * _SIZE
+            if left + _SIZE < len(nodes):
+                digest = hash_node(bytes(nodes[left:left+_SIZE]), bytes(nodes[left+_SIZE:left+2*_SIZE]))
+            else:
+                digest = bytes(nodes[left:left+_SIZE])
+            if level + 1 == len(self._levels):
+                self._levels.append(bytearray())
+            parent = self._levels[level+1]
+            index >>= 1
+            parent[index*_SIZE:(index+1)*_SIZE] = digest
+            level += 1
+
+    @property
+    def root(self):
+        if not self._levels[0]:
+            return hashlib.sha256().digest()
+        return bytes(self._levels[-1][:_SIZE])
 
     @property
     def root_hash(self):
-        return self.root_node.data #get the root_hash of the merkle root
+        return self.root.hex() #get the root_hash of the merkle root
+
+    def proof(self, index):
+        """
+        The siblings on the path from leaf index to the root, as a list of
+        (side, digest hex) where side tells if the sibling is on the left
+        ('l') or the right ('r')
+        """
+        if not 0 <= index < len(self):
+            raise IndexError('leaf index is out of range')
+        path = []
+        for nodes in self._levels[:-1]:
+            sibling = index ^ 1
+            if sibling * _SIZE < len(nodes):
+                side = 'l' if sibling < index else 'r'
+                path.append((side, nodes[sibling*_SIZE:(sibling+1)*_SIZE].hex()))
+            index >>= 1
+        return path
+
+def verify_proof(leaf, proof, root):
+    """
+    Check that leaf, the data of a leaf, is in the tree of root (hex)
+    """
+    digest = hash_leaf(leaf)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        if side == 'l':
+            digest = hash_node(sibling, digest)
+        else:
+            digest = hash_node(digest, sibling)
+    return digest.hex() == root
 
-if __name__ == "__main__":
-    datas = ['{"txid": "4cd7ed3feecf6cefa38abdeaff2410c4f12e646ba0efccfd5049555072a07372", "vins": [{"txid": "49dd3010dd74654615a1756736e60031a2576ea47f927c3f80af7beb750002e5", "vout": 1, "signature": "c5b23ea6ca87e91b320b10fe90d40d89a86f42ef9d516dbe5f4d96f6d7c66229702bf61736541310557d92ab24d79b1aa6b13fed24c2eae19a652f62399ebfdc", "pub_key": "544adad8e3c5c444aa5861664ad2ff926060e8fe136efb10b978dc63494c4916b3e076064967c08027173fddd09a916f18ec5e6f7cb27ca6eda141d088a51d5f"}], "vouts": [{"value": 20, "pub_key_hash": "LPVe8zSdg2Ur1gWcu7s6Ph11ojBeHHnK5d"}, {"value": 920, "pub_key_hash": "LURchFoVQdFbvrdUaJ1LhEy3PLLJj5zhyp"}]}', '{"txid": "76fcb8f74eb6b141a5c24131d6f230ee363fce28d1380f9eb29be6800c840abf", "vins": [{"txid": "1e1dc659067abd638fa943b8c75c6d4da4126aaba78622923a54676fd5964168", "vout": 0, "signature": "0991bb9d44ef8c80f88040cfbc5ba409b3af0cdf645fba7acc0e1d3db9500a35fc61b5d3f376c755ace1cc527398e47e5e03f2da11c0366896399906a15ef579", "pub_key": "c39c37739dc56a5abe182456ae32da974e8aee1cbc26f74edbb6bb3d84385c035afa0476cfcefc565fa47d057be22160cceeda1525dd75d1c12fbd13b27ce9f2"}, {"txid": "290a67f73ff4b845d03e577786a1619d809a70d0ffb55c096e4df41d5c1e8604", "vout": 0, "signature": "4de7a654f739b2a4be5ae43b8800c8ca5ab94aebbeab70d59466a728be0335c61151f4562fa206ccaee56f34b47d775d2ccf9b23ce6ea7a98742851f378934df", "pub_key": "c39c37739dc56a5abe182456ae32da974e8aee1cbc26f74edbb6bb3d84385c035afa0476cfcefc565fa47d057be22160cceeda1525dd75d1c12fbd13b27ce9f2"}], "vouts": [{"value": 20, "pub_key_hash": "LURchFoVQdFbvrdUaJ1LhEy3PLLJj5zhyp"}]}', '{"txid": "76fcb8f74eb6b141a5c24131d6f230ee363fce28d1380f9eb29be6800c840abf", "vins": [{"txid": "1e1dc659067abd638fa943b8c75c6d4da4126aaba78622923a54676fd5964168", "vout": 0, "signature": "0991bb9d44ef8c80f88040cfbc5ba409b3af0cdf645fba7acc0e1d3db9500a35fc61b5d3f376c755ace1cc527398e47e5e03f2da11c0366896399906a15ef579", "pub_key": "c39c37739dc56a5abe182456ae32da974e8aee1cbc26f74edbb6bb3d84385c035afa0476cfcefc565fa47d057be22160cceeda1525dd75d1c12fbd13b27ce9f2"}, {"txid": "290a67f73ff4b845d03e577786a1619d809a70d0ffb55c096e4df41d5c1e8604", "vout": 0, "signature": "4de7a654f739b2a4be5ae43b8800c8ca5ab94aebbeab70d59466a728be0335c61151f4562fa206ccaee56f34b47d775d2ccf9b23ce6ea7a98742851f378934df", "pub_key": "c39c37739dc56a5abe182456ae32da974e8aee1cbc26f74edbb6bb3d84385c035afa0476cfcefc565fa47d057be22160cceeda1525dd75d1c12fbd13b27ce9f2"}], "vouts": [{"value": 20, "pub_key_hash": "LURchFoVQdFbvrdUaJ1LhEy3PLLJj5zhyp"}]}']
-    t = MerkleTree(datas)
\ No newline at end of file
+def legacy_root_hash(datas):
+    """
+    Root of the trees built before the level arrays, the hex digests of
+    the children were concatenated and hashed again
+    """
+    def sum256_hex(data):
+        return hashlib.sha256(_encode(data)).hexdigest()
+    nodes = [sum256_hex(data) for data in datas]
+    while len(nodes) > 1:
+        level = []
+        for k in range(0, len(nodes), 2):
+            if k + 1 < len(nodes):
+                level.append(sum256_hex(nodes[k] + nodes[k+1]))
+            else:
+                level.append(nodes[k])
+        nodes = level
+    return nodes[0]
@@ -0,0 +1,104 @@
+# coding:utf-8
+"""
+Background miner.
+Mining runs on its own thread so callers hand over a block template and
+return at once. The search is cancelled as soon as the chain tip moves
+away from the template's parent, e.g. when a peer's block is accepted,
+the block assembler then hands over a template built on the new tip.
+"""
+import logging
+import threading
+
+from block_chain import BlockChain
+from txpool import Mempool
+from errors import MiningCancelledError, NonceNotFoundError, TransactionVerifyError
+from utils import Singleton
+
+log = logging.getLogger('kademlia')
+
+class Miner(Singleton):
+    def __init__(self):
+        if not hasattr(self, "_thread"):
+            self._cond = threading.Condition(threading.RLock())
+            self._template = None
+            self._stop = threading.Event()
+            self._callbacks = []
+            self.mined = 0
+            self.cancelled = 0
+            BlockChain.add_tip_listener(self.on_tip_changed)
+            self._thread = threading.Thread(target=self._loop, name='miner')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def add_callback(self, callback):
+        """callback(block) is called with every block mined"""
+        self._callbacks.append(callback)
+
+    def submit(self, template):
+        """
+        Mine template, abandoning the block being mined if any
+        """
+        with self._cond:
+            if self._template is not None:
+                self._stop.set()
+            self._template = template
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._template = None
+            self._stop.set()
+
+    @property
+    def busy(self):
+        return self._template is not None
+
+    def on_tip_changed(self, tip_hash):
+        with self._cond:
+            template = self._template
+            if template is None or template.block_header.prev_block_hash == tip_hash:
+                return
+            self._stop.set()
+            self._template = None
+
+    @staticmethod
+    def _drop_invalid(bc, block):
+        # the same template would be built again from the pool otherwise
+        txs = [tx for tx in block.transactions if not tx.is_coinbase()]
+        bad = [tx.txid for tx in txs if not bc.verify_transaction(tx)]
+        if not bad:
+            # valid one by one but not together, nothing tells which to keep
+            bad = [tx.txid for tx in txs]
+        removed = Mempool().remove(bad)
+        log.info('%d invalid transactions dropped from the mempool' % len(removed))
+
+    def _loop(self):
+        bc = BlockChain()
+        while True:
+            with self._cond:
+                while self._template is None:
+                    self._cond.wait()
+                block = self._template
+                self._stop.clear()
+            try:
+                block.mine(bc, self._stop)
+            except MiningCancelledError:
+                self.cancelled += 1
+                continue
+            except (NonceNotFoundError, TransactionVerifyError) as e:
+                log.info('mining aborted: %s' % e)
+                if isinstance(e, TransactionVerifyError):
+                    self._drop_invalid(bc, block)
+                with self._cond:
+                    if self._template is block:
+                        self._template = None
+                continue
+            with self._cond:
+                # a newer template arrived while the search was finishing
+                if self._template is not block:
+                    continue
+                self._template = None
+            self.mined += 1
+            block.set_header_hash()
+            for callback in self._callbacks:
+                callback(block)
@@ -1,7 +1,6 @@
 # coding:utf-8
 
 import threading
-import sys
 import time
 import logging
 import asyncio
@@ -10,11 +9,10 @@ import json
 
 from kademlia.network import Server
 from block_chain import BlockChain
-from block import Block
-from txpool import TxPool
-from transactions import Transaction
+from admission import AdmissionQueue
+from codec import pack_block, unpack_block, pack_tx
 from utils import Singleton
-from conf import bootstrap_host, bootstrap_port, listen_port
+from conf import bootstrap_host, bootstrap_port, listen_port, admission_retry_after, peer_max_message
 
 handler = logging.StreamHandler()
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -51,43 +49,87 @@ class Msg(object):
     HAND_SHAKE_MSG = 1
     GET_BLOCK_MSG = 2
     TRANSACTION_MSG = 3
+    BUSY_MSG = 4
     def __init__(self, code, data):
         self.code = code
         self.data = data
 
 class TCPServer(object):
+    '''
+    Every peer connection is served by one asyncio event loop running on a
+    single thread. Messages are JSON documents ended by a newline, the
+    reply to each one is sent the same way.
+    '''
     def __init__(self, ip='0.0.0.0', port=listen_port):
         self.sock = socket.socket()
         self.ip = ip
         self.port = port
-    
+        self.loop = None
+        self.server = None
+        self.connections = 0
+
     def listen(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.ip, self.port))
-        self.sock.listen(5)
+        self.sock.listen(128)
 
     def run(self):
-        t = threading.Thread(target=self.listen_loop, args=())
+        self.loop = asyncio.new_event_loop()
+        t = threading.Thread(target=self.serve_forever, args=(), name='tcpserver')
+        t.daemon = True
         t.start()
 
-    def handle_loop(self, conn, addr):
-        while True:
-            recv_data = conn.recv(4096)
-            log.info("recv_data:"+str(recv_data))
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle_connection, sock=self.sock, limit=peer_max_message))
+        self.loop.run_forever()
+
+    def stop(self):
+        def close():
+            self.server.close()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(close)
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        self.connections += 1
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                try:
+                    recv_data = await reader.readline()
+                except ValueError:
+                    log.info("message from %s is too long" % str(addr))
+                    break
+                # an empty read is the end of the stream, the peer is gone
+                if not recv_data:
+                    break
+                if not recv_data.strip():
+                    continue
+                log.info("recv_data:"+str(recv_data))
+                try:
+                    recv_msg = json.loads(recv_data)
+                except ValueError as e:
+                    recv_msg = {}
+                # database reads would stall every connection on the loop
+                send_data = await loop.run_in_executor(None, self.handle, recv_msg)
+                log.info("tcpserver_send:"+send_data)
+                writer.write(send_data.encode() + b'\n')
+                await writer.drain()
+        except ConnectionError as e:
+            log.info("connection with %s lost: %s" % (str(addr), e))
+        finally:
+            writer.close()
             try:
-                recv_msg = json.loads(recv_data)
-            except ValueError as e:
-                conn.sendall('{"code": 0, "data": ""}'.encode())
-            send_data = self.handle(recv_msg)
-            log.info("tcpserver_send:"+send_data)
-            conn.sendall(send_data.encode())
-
-    def listen_loop(self):
-        while True:
-            conn, addr = self.sock.accept()
-            t = threading.Thread(target=self.handle_loop, args=(conn, addr))
-            t.start()
+                await writer.wait_closed()
+            except OSError as e:
+                log.info("closing the connection with %s failed: %s" % (str(addr), e))
+            self.connections -= 1
 
     def handle(self, msg):
+        if not isinstance(msg, dict):
+            return '{"code": 0, "data":""}'
         code = msg.get("code", 0)
         log.info("code:"+str(code))
         if code == Msg.HAND_SHAKE_MSG:
@@ -114,30 +156,35 @@ class TCPServer(object):
         if genesis_block:
             data = {
                 "last_height": block.block_header.height,
-                "genesis_block": genesis_block.serialize()
+                "genesis_block": pack_block(genesis_block)
             }
         msg = Msg(Msg.HAND_SHAKE_MSG, data)
         return msg
 
     def handle_get_block(self, msg):
         height = msg.get("data", 1)
+        if not isinstance(height, int):
+            return Msg(Msg.NONE_MSG, "")
         block_chain = BlockChain()
         block = block_chain.get_block_by_height(height)
-        data = block.serialize()
+        if block is None:
+            return Msg(Msg.NONE_MSG, "")
+        data = pack_block(block)
         msg = Msg(Msg.GET_BLOCK_MSG, data)
         return msg
 
     def handle_transaction(self, msg):
-        tx_pool = TxPool()
-        txs = msg.get("data", {})
-        for tx_data in txs:
-            tx = Transaction.deserialize(tx_data)
-            tx_pool.add(tx)
-        if tx_pool.is_full():
-            bc = BlockChain()
-            bc.add_block(tx_pool.txs)
-            log.info("add block")
-            tx_pool.clear()
+        # validation happens on the admission workers, not on this thread
+        admission = AdmissionQueue()
+        txs = msg.get("data", [])
+        for accepted, tx_data in enumerate(txs):
+            if not admission.submit(tx_data):
+                log.info("admission queue is full, %d transactions refused" % (len(txs) - accepted))
+                data = {
+                    "accepted": accepted,
+                    "retry_after": admission_retry_after
+                }
+                return Msg(Msg.BUSY_MSG, data)
         msg = Msg(Msg.NONE_MSG, "")
         return msg
 
@@ -145,18 +192,20 @@ class TCPServer(object):
 class TCPClient(object):
     def __init__(self, ip, port):
         self.txs = []
+        self.sent_txs = []
         self.sock = socket.socket()
         log.info("connect ip:"+ip+"\tport:"+str(port))
         self.sock.connect((ip, port))
+        self.rfile = self.sock.makefile('rb')
 
     def add_tx(self, tx):
         self.txs.append(tx)
     
     def send(self, msg):
         data = json.dumps(msg.__dict__)
-        self.sock.sendall(data.encode())
+        self.sock.sendall(data.encode() + b'\n')
         log.info("send:"+data)
-        recv_data = self.sock.recv(4096)
+        recv_data = self.rfile.readline(peer_max_message)
         log.info("client_recv_data:"+str(recv_data))
         try:
             recv_msg = json.loads(recv_data)
@@ -173,14 +222,16 @@ class TCPClient(object):
             self.handle_get_block(msg)
         elif code == Msg.TRANSACTION_MSG:
             self.handle_transaction(msg)
+        elif code == Msg.BUSY_MSG:
+            self.handle_busy(msg)
 
     def shake_loop(self):
         while True:
             if self.txs:
-                data = [tx.serialize() for tx in self.txs]
+                self.sent_txs, self.txs = self.txs, []
+                data = [pack_tx(tx) for tx in self.sent_txs]
                 msg = Msg(Msg.TRANSACTION_MSG, data)
                 self.send(msg)
-                self.txs.clear()
             else:
                 log.info("shake")
                 block_chain = BlockChain()
@@ -196,7 +247,7 @@ class TCPClient(object):
                 if genesis_block:
                     data = {
                         "last_height": block.block_header.height,
-                        "genesis_block": genesis_block.serialize()
+                        "genesis_block": pack_block(genesis_block)
                     }
                 msg = Msg(Msg.HAND_SHAKE_MSG, data)
                 self.send(msg)
@@ -222,7 +273,7 @@ class TCPClient(object):
 
     def handle_get_block(self, msg):
         data = msg.get("data", "")
-        block = Block.deserialize(data)
+        block = unpack_block(data)
         bc = BlockChain()
         try:
             bc.add_block_from_peers(block)
@@ -231,15 +282,18 @@ class TCPClient(object):
 
     def handle_transaction(self, msg):
         data = msg.get("data", {})
-        tx = Transaction.deserialize(data)
-        tx_pool = TxPool()
-        tx_pool.add(tx)
-        if tx_pool.is_full():
-            bc.add_block(tx_pool.txs)
-            log.info("mined a block")
-            tx_pool.clear()
+        AdmissionQueue().submit(data)
+
+    def handle_busy(self, msg):
+        # the peer is saturated, send the refused transactions again later
+        data = msg.get("data", {})
+        refused = self.sent_txs[data.get("accepted", 0):]
+        self.txs[:0] = refused
+        log.info("peer is busy, %d transactions to resend" % len(refused))
+        time.sleep(data.get("retry_after", admission_retry_after))
 
     def close(self):
+        self.rfile.close()
         self.sock.close()
 
 
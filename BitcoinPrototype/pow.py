@@ -2,80 +2,242 @@
 import sys
 import utils
 import time
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
 
 #in this demo, if not found the nonce(its not possible), just pass it in case some errors happen.
-from errors import NonceNotFoundError
+from errors import NonceNotFoundError, MiningCancelledError
+from conf import mining_workers, mining_chunk_size, target_block_interval, retarget_window
+
+# Set in the worker processes, tells them to drop the current chunk
+_stop_event = None
+# Nonces hashed between two checks of the stop event
+_BATCH = 1 << 12
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+def _search(prefix, target, start, end, stop=None, progress=None):
+    """
+    Search the nonces in [start, end), return (nonce, hash_hex) or None.
+    The prefix is hashed once and its state copied for every nonce,
+    digests are compared as bytes against the target.
+    """
+    stop = stop or _stop_event
+    if target >> 256:
+        # every hash meets the target
+        return start, utils.sum256_hex(prefix + b'%d' % start)
+    target_bytes = target.to_bytes(32, 'big')
+    copy = hashlib.sha256(prefix).copy
+    for batch_start in range(start, end, _BATCH):
+        if stop is not None and stop.is_set():
+            return None
+        for nonce in range(batch_start, min(batch_start + _BATCH, end)):
+            h = copy()
+            h.update(b'%d' % nonce)
+            if h.digest() < target_bytes:
+                return nonce, h.hexdigest()
+        if progress:
+            progress(min(batch_start + _BATCH, end))
+    return None
+
+def bits_to_target(bits):
+    """
+    Expand the compact form of a target: the high byte is the size of the
+    target in bytes, the low three bytes its most significant bytes.
+    """
+    size = bits >> 24
+    mantissa = bits & 0x7FFFFF
+    if size <= 3:
+        return mantissa >> (8 * (3 - size))
+    return mantissa << (8 * (size - 3))
+
+def target_to_bits(target):
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    # the mantissa is unsigned, keep its top bit clear
+    if mantissa & 0x800000:
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+def retarget(bits, actual_timespan, target_timespan):
+    """
+    Scale the target by how long the last window took compared to the
+    wanted timespan, at most by a factor of 4 each way.
+    """
+    actual_timespan = max(target_timespan / 4, min(actual_timespan, target_timespan * 4))
+    target = bits_to_target(bits)
+    target = target * int(actual_timespan * 1000) // int(target_timespan * 1000)
+    return target_to_bits(max(1, min(target, ProofOfWork.POW_LIMIT)))
+
+class MiningPool(object):
+    """Worker processes shared by every ProofOfWork.
+    The nonce space is cut in chunks handed out in order, so the result is
+    the lowest matching nonce, the same one the single process search finds.
+    """
+    _lock = threading.Lock()
+    _pools = {}
+
+    def __init__(self, workers, chunk_size=mining_chunk_size):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._stop = multiprocessing.Event()
+        self._pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                          initargs=(self._stop,))
+        # one search at a time, they share the stop event
+        self._search_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, workers):
+        with cls._lock:
+            if workers not in cls._pools:
+                cls._pools[workers] = cls(workers)
+            return cls._pools[workers]
+
+    def search(self, prefix, target, max_nonce, stop=None):
+        """
+        Return (nonce, hash_hex), or None once the nonces run out
+        or the stop event is set.
+        """
+        with self._search_lock:
+            return self._search(prefix, target, max_nonce, stop)
+
+    def _search(self, prefix, target, max_nonce, stop):
+        pending = deque()
+        next_start = 0
+        try:
+            while True:
+                # Keep every worker busy, with a little look ahead
+                while len(pending) < self.workers * 2 and next_start < max_nonce:
+                    end = min(next_start + self.chunk_size, max_nonce)
+                    pending.append(self._pool.apply_async(
+                        _search, (prefix, target, next_start, end)))
+                    next_start = end
+                if not pending:
+                    return None
+                res = pending.popleft()
+                while not res.ready():
+                    res.wait(0.05)
+                    if stop is not None and stop.is_set():
+                        pending.append(res)
+                        return None
+                result = res.get()
+                if result:
+                    return result
+        finally:
+            # Stop the chunks still running and wait for them to return
+            self._stop.set()
+            for res in pending:
+                res.wait()
+            self._stop.clear()
+
+    def close(self):
+        self._pool.terminate()
 
 #POW
 class ProofOfWork(object):
     _N_BITS = 4
     MAX_BITS = 256
     MAX_SIZE = sys.maxsize 
+    # The easiest target allowed, also the one of the genesis block
+    POW_LIMIT = 1 << (MAX_BITS - _N_BITS)
+    INITIAL_BITS = target_to_bits(POW_LIMIT)
+    TARGET_INTERVAL = target_block_interval
+    RETARGET_WINDOW = retarget_window
     runtime=0
 
-    def __init__(self, block, n_bits=_N_BITS):
-        self._n_bits = n_bits
-        self._target_bits = 1 << (self.MAX_BITS - n_bits)#The target difficult value is a fixed value, not automatic.
+    def __init__(self, block, n_bits=None, workers=mining_workers):
+        self._workers = workers
         self._block = block
+        bits = block.block_header.bits
+        if n_bits is not None:
+            self._target_bits = 1 << (self.MAX_BITS - n_bits)
+        elif bits is None:
+            # blocks mined before retargeting used a fixed difficulty
+            self._target_bits = 1 << (self.MAX_BITS - self._N_BITS)
+        else:
+            self._target_bits = bits_to_target(bits)
+
+    @classmethod
+    def next_bits(cls, height, prev_bits, window_timespan=None):
+        """
+        Difficulty of the block at height. It changes every RETARGET_WINDOW
+        blocks, window_timespan is the time between the first and the last
+        block of the window that just ended.
+        """
+        if prev_bits is None:
+            return cls.INITIAL_BITS
+        if height % cls.RETARGET_WINDOW or window_timespan is None:
+            return prev_bits
+        target_timespan = cls.TARGET_INTERVAL * (cls.RETARGET_WINDOW - 1)
+        return retarget(prev_bits, window_timespan, target_timespan)
 
     def _prepare_data(self, nonce):
+        bits = self._block.block_header.bits
         data_lst = [str(self._block.block_header.prev_block_hash),#the previous block's hash.
                     str(self._block.block_header.hash_merkle_root),#this block's merkle tree_root.
                     str(self._block.block_header.timestamp),#the timestamp.
                     str(self._block.block_header.height),#height.
+                    '' if bits is None else str(bits),#the difficulty.
                     str(nonce)]#the nonce that may meet the demand of the block.
         return utils.encode(''.join(data_lst))
 
-    def run(self):
-        nonce = 0
-        found = False#if find the nonce, this value will be True
-        hash_hex = None
+    def run(self, stop=None):
+        """
+        Search the nonce, setting the stop event aborts the search
+        with MiningCancelledError.
+        """
+        if self._workers > 1:
+            return self._run_parallel(stop)
+        return self._run_serial(stop)
+
+    def _run_parallel(self, stop=None):
+        print('Mining a new block with %d workers' % self._workers)
+        startTime = time.time()
+        # The nonce is the last field of the data, the rest never changes
+        prefix = self._prepare_data('')
+        result = MiningPool.get(self._workers).search(prefix, self._target_bits, self.MAX_SIZE, stop)
+        if stop is not None and stop.is_set():
+            raise MiningCancelledError('mining cancelled')
+        if not result:
+            print('Not Found nonce')
+            raise NonceNotFoundError('nonce not found')
+        print('Found nonce == %d' % result[0])
+        self.runtime = time.time() - startTime
+        return result
+
+    # Single process search, also the fallback when no workers are configured
+    def _run_serial(self, stop=None):
         print('Mining a new block')
-        
         startTime=time.time()
-        while nonce < self.MAX_SIZE:
-            #time.sleep(1)
-            data = self._prepare_data(nonce)
-            #using the hash function to get the hash value with the certain nonce.
-            hash_hex = utils.sum256_hex(data)
-            #transfer the value to hex.
-            hash_val = int(hash_hex, 16)
-            self.bc.getLastblock()
-            #output the result:
-            sys.stdout.write("data: %s\n" % data)
-            sys.stdout.write("try nonce == %d\thash_hex == %s \n" % (nonce, hash_hex))
-            if (hash_val < self._target_bits):
-                found = True
-                break
-            #if the nonce is not meet the demand, nonce++, until find the correct nonce that make hash value < the target value.
-            nonce += 1 
-        if found: 
-            print('Found nonce == %d' % nonce)
-        else:
+        #the nonce is the last field of the data, the rest never changes.
+        prefix = self._prepare_data('')
+        result = _search(prefix, self._target_bits, 0, self.MAX_SIZE,
+                         stop=stop, progress=self._report_progress)
+        if stop is not None and stop.is_set():
+            raise MiningCancelledError('mining cancelled')
+        if not result:
             print('Not Found nonce')
             raise NonceNotFoundError('nonce not found')
+        print('Found nonce == %d' % result[0])
         endTime=time.time()
 
         self.runtime=endTime-startTime
-        #self._N_BITS=self.adjust_N_BITS(self, startTime, endTime)
-        return nonce, hash_hex#The final result.
-    '''
-    def adjust_N_BITS(self, startTime, currentTime):
-        
-        tt = startTime + 5
-        #tt is a tolerance time
-        bottom_line_time = 1
-        #Current time is the last endtime
-        # If the mining time less than 4s, we need to improve the difficulty
-        if tt - int(currentTime) >= bottom_line_time:
-            _N_BITS = _N_BITS+1
-        # If the mining time more than 6s, we need to reduce the difficulty    
-        if int(currentTime) - tt > bottom_line_time :
-            _N_BITS = _N_BITS-1
-        return _N_BITS
-    '''
-    def getLastblock(self):
-        self.bc.get_head_hash()
+        return result#The final result.
+
+    # Nonces tried between two progress lines
+    PROGRESS_INTERVAL = 1 << 20
+
+    def _report_progress(self, tried):
+        if tried % self.PROGRESS_INTERVAL == 0:
+            sys.stdout.write("tried %d nonces\n" % tried)
     def validate(self):
         """
         validate the block
@@ -0,0 +1,79 @@
+# coding:utf-8
+"""
+A bounded cache of signatures that verified successfully.
+A transaction is checked when it enters the pool, when its block is mined
+and again when peers relay that block. The cache remembers every valid
+(sighash, pub_key, signature) check, so the later passes skip the ECDSA
+work. The sighash already commits to the txid and the input index, the
+key and signature are part of the entry so a replaced signature misses.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils import Singleton
+from conf import sigcache_size
+
+class SignatureCache(Singleton):
+    """A LRU set of verified signature checks
+    Attributes:
+        max_entries (int): How many checks are kept before evicting.
+        hits (int): Checks answered from the cache.
+        misses (int): Checks that needed an ECDSA verification.
+    """
+    def __init__(self, max_entries=sigcache_size):
+        if hasattr(self, '_entries'):
+            return
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(check):
+        sighash, pub_key, signature = check
+        m = hashlib.sha256(sighash)
+        m.update(b'|%s|%s' % (str(pub_key).encode(), str(signature).encode()))
+        return m.digest()
+
+    def contains(self, check):
+        key = self._key(check)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def missing(self, checks):
+        """The checks that are not cached yet"""
+        return [check for check in checks if not self.contains(check)]
+
+    def add(self, check):
+        self.add_many([check])
+
+    def add_many(self, checks):
+        keys = [self._key(check) for check in checks]
+        with self._lock:
+            for key in keys:
+                self._entries[key] = True
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
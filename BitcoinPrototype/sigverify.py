@@ -0,0 +1,111 @@
+# coding:utf-8
+"""
+Signature verification scheduler.
+The signatures of a block are collected as (sighash, pub_key, signature)
+triples and checked across a pool of worker processes. The first bad
+signature stops every worker, and small blocks are checked in the calling
+process, where starting the pool would cost more than it saves.
+"""
+import multiprocessing
+import threading
+
+from transactions import verify_signature
+from conf import sigverify_workers, sigverify_min_parallel
+
+# Set in the worker processes, tells them to drop their chunk
+_stop_event = None
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+def _verify_chunk(checks):
+    for check in checks:
+        if _stop_event is not None and _stop_event.is_set():
+            return True
+        if not verify_signature(*check):
+            return False
+    return True
+
+def _verify_chunk_each(checks):
+    return [verify_signature(*check) for check in checks]
+
+def verify_serial(checks):
+    for check in checks:
+        if not verify_signature(*check):
+            return False
+    return True
+
+class SignatureVerifier(object):
+    """Worker processes shared by every block verification."""
+    _lock = threading.Lock()
+    _verifiers = {}
+
+    def __init__(self, workers=sigverify_workers, min_parallel=sigverify_min_parallel):
+        self.workers = workers
+        self.min_parallel = min_parallel
+        self._pool = None
+        self._stop = None
+        # one block at a time, they share the stop event
+        self._verify_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, workers=sigverify_workers):
+        with cls._lock:
+            if workers not in cls._verifiers:
+                cls._verifiers[workers] = cls(workers)
+            return cls._verifiers[workers]
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._stop = multiprocessing.Event()
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                              initargs=(self._stop,))
+        return self._pool
+
+    def verify(self, checks):
+        """
+        Return True if every signature is valid
+        """
+        checks = list(checks)
+        if self.workers <= 1 or len(checks) < self.min_parallel:
+            return verify_serial(checks)
+        with self._verify_lock:
+            return self._verify_parallel(checks)
+
+    def verify_each(self, checks):
+        """
+        The result of every check, in order, nothing stops at a bad one
+        """
+        checks = list(checks)
+        if self.workers <= 1 or len(checks) < self.min_parallel:
+            return _verify_chunk_each(checks)
+        with self._verify_lock:
+            pool = self._get_pool()
+            size = -(-len(checks) // (self.workers * 4))
+            chunks = [checks[i:i+size] for i in range(0, len(checks), size)]
+            return [ok for chunk in pool.map(_verify_chunk_each, chunks) for ok in chunk]
+
+    def _verify_parallel(self, checks):
+        pool = self._get_pool()
+        # a few chunks per worker so a slow one does not hold the others
+        n_chunks = self.workers * 4
+        size = -(-len(checks) // n_chunks)
+        chunks = [checks[i:i+size] for i in range(0, len(checks), size)]
+        results = pool.imap_unordered(_verify_chunk, chunks)
+        try:
+            for ok in results:
+                if not ok:
+                    return False
+            return True
+        finally:
+            # drain what the workers still hold before the next block
+            self._stop.set()
+            for _ in results:
+                pass
+            self._stop.clear()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
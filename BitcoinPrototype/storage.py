@@ -0,0 +1,336 @@
+# coding:utf-8
+"""
+Storage engines used by db.DB.
+Every engine stores JSON documents under string keys and offers the same
+small set of operations: point gets, ordered prefix/range scans and
+batched writes. CouchDB talks to a remote server over HTTP, SQLite keeps
+everything in a single local file so a node can run without any external
+service.
+"""
+import json
+import re
+import sqlite3
+import threading
+
+from errors import DocumentConflictError, DocumentNotFoundError
+
+class StorageEngine(object):
+    """The interface every storage engine implements.
+    Documents are plain dicts, the key of a returned document is
+    available under '_id'.
+    """
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """
+        Fetch several documents at once, returns a dict of key -> doc
+        holding only the keys that exist.
+        """
+        docs = {}
+        for key in keys:
+            doc = self.get(key)
+            if doc is not None:
+                docs[key] = doc
+        return docs
+
+    def contains(self, key):
+        return self.get(key) is not None
+
+    # Insert a new document, fail if the key is already used
+    def create(self, key, doc):
+        raise NotImplementedError
+
+    # Insert or overwrite a document
+    def put(self, key, doc):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def scan(self, prefix='', start=None, end=None):
+        """
+        Iterate (key, doc) pairs in key order.
+        Only keys starting with prefix and inside [start, end) are returned.
+        """
+        raise NotImplementedError
+
+    def write_batch(self, puts=None, deletes=None):
+        """
+        Apply several writes at once.
+        puts is a dict of key -> doc to insert or overwrite,
+        deletes is a list of keys to remove (missing keys are ignored).
+        """
+        raise NotImplementedError
+
+    def find(self, query):
+        """
+        Run a Mango style query, kept for callers that still use selectors.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def _strip_meta(doc):
+    return dict((k, v) for k, v in doc.items() if k not in ('_id', '_rev'))
+
+def _prefix_end(prefix):
+    # The smallest string greater than every string starting with prefix
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _match_value(cond, value):
+    if isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+        for op, arg in cond.items():
+            if op == '$eq' and value != arg:
+                return False
+            elif op == '$regex' and not (isinstance(value, str) and re.search(arg, value)):
+                return False
+            elif op == '$elemMatch':
+                if not isinstance(value, list):
+                    return False
+                if not any(_match_value(arg, item) for item in value):
+                    return False
+        return True
+    if isinstance(cond, dict):
+        if not isinstance(value, dict):
+            return False
+        return all(_match_value(v, value.get(k)) for k, v in cond.items())
+    return cond == value
+
+def match_selector(selector, doc):
+    """The subset of Mango selectors the node uses: nested equality,
+    $eq, $regex and $elemMatch."""
+    return _match_value(selector, doc)
+
+class CouchDBEngine(StorageEngine):
+    """Documents live in a CouchDB database.
+    CouchDB has no multi-document transactions, write_batch sends all
+    writes in one _bulk_docs request but is not atomic.
+    """
+    def __init__(self, db_server_url, db_name='block_chain'):
+        import couchdb
+        self._couchdb = couchdb
+        self._db_server_url = db_server_url
+        self._server = couchdb.Server(self._db_server_url)
+        self._db_name = db_name
+        self._db = None
+
+    @property
+    def db(self):
+        if not self._db:
+            try:
+                self._db = self._server[self._db_name]
+            except self._couchdb.ResourceNotFound:
+                self._db = self._server.create(self._db_name)
+        return self._db
+
+    def get(self, key, default=None):
+        return self.db.get(key, default)
+
+    def get_many(self, keys):
+        docs = {}
+        keys = list(keys)
+        if not keys:
+            return docs
+        for row in self.db.view('_all_docs', keys=keys, include_docs=True):
+            if row.get('error') or row.doc is None:
+                continue
+            docs[row.key] = row.doc
+        return docs
+
+    def contains(self, key):
+        return key in self.db
+
+    def create(self, key, doc):
+        try:
+            self.db[key] = _strip_meta(doc)
+        except self._couchdb.ResourceConflict as e:
+            raise DocumentConflictError(key) from e
+        return key
+
+    def put(self, key, doc):
+        self.write_batch(puts={key: doc})
+        return key
+
+    def delete(self, key):
+        doc = self.db.get(key)
+        if doc is None:
+            raise DocumentNotFoundError(key)
+        try:
+            self.db.delete(doc)
+        except self._couchdb.ResourceNotFound as e:
+            raise DocumentNotFoundError(key) from e
+
+    def _revs(self, keys):
+        revs = {}
+        if not keys:
+            return revs
+        for row in self.db.view('_all_docs', keys=list(keys)):
+            if row.get('error') or not row.value or row.value.get('deleted'):
+                continue
+            revs[row.key] = row.value['rev']
+        return revs
+
+    def scan(self, prefix='', start=None, end=None):
+        low = max(prefix, start) if start is not None else prefix
+        high = _prefix_end(prefix)
+        if end is not None and (high is None or end < high):
+            high = end
+        options = {'include_docs': True}
+        if low:
+            options['startkey'] = low
+        if high is not None:
+            options['endkey'] = high
+            options['inclusive_end'] = False
+        for row in self.db.view('_all_docs', **options):
+            if row.id.startswith('_design/'):
+                continue
+            yield row.id, row.doc
+
+    def write_batch(self, puts=None, deletes=None):
+        puts = puts or {}
+        deletes = deletes or []
+        # One request for the current revisions, one for the writes
+        revs = self._revs(list(puts.keys()) + list(deletes))
+        docs = []
+        for key, doc in puts.items():
+            doc = _strip_meta(doc)
+            doc['_id'] = key
+            if key in revs:
+                doc['_rev'] = revs[key]
+            docs.append(doc)
+        for key in deletes:
+            if key in revs and key not in puts:
+                docs.append({'_id': key, '_rev': revs[key], '_deleted': True})
+        if not docs:
+            return
+        for ok, key, error in self.db.update(docs):
+            if not ok:
+                raise DocumentConflictError('%s: %s' % (key, error))
+
+    def find(self, query):
+        return self.db.find(query)
+
+class SQLiteEngine(StorageEngine):
+    """Documents live in a local SQLite file, one row per key.
+    Batches run inside a single transaction, so they are atomic.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS docs ('
+                           'key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+
+    @staticmethod
+    def _load(key, value):
+        doc = json.loads(value)
+        doc['_id'] = key
+        return doc
+
+    @staticmethod
+    def _dump(doc):
+        return json.dumps(_strip_meta(doc))
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM docs WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return self._load(key, row[0])
+
+    def get_many(self, keys):
+        docs = {}
+        keys = list(set(keys))
+        # Stay below SQLite's limit on bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            sql = 'SELECT key, value FROM docs WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(sql, chunk).fetchall()
+            for key, value in rows:
+                docs[key] = self._load(key, value)
+        return docs
+
+    def contains(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM docs WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def create(self, key, doc):
+        try:
+            with self._lock:
+                self._conn.execute('INSERT INTO docs (key, value) VALUES (?, ?)',
+                                   (key, self._dump(doc)))
+        except sqlite3.IntegrityError as e:
+            raise DocumentConflictError(key) from e
+        return key
+
+    def put(self, key, doc):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO docs (key, value) VALUES (?, ?)',
+                               (key, self._dump(doc)))
+        return key
+
+    def delete(self, key):
+        with self._lock:
+            cur = self._conn.execute('DELETE FROM docs WHERE key = ?', (key,))
+        if cur.rowcount == 0:
+            raise DocumentNotFoundError(key)
+
+    def scan(self, prefix='', start=None, end=None):
+        low = max(prefix, start) if start is not None else prefix
+        high = _prefix_end(prefix)
+        if end is not None and (high is None or end < high):
+            high = end
+        sql = 'SELECT key, value FROM docs WHERE key >= ?'
+        args = [low]
+        if high is not None:
+            sql += ' AND key < ?'
+            args.append(high)
+        sql += ' ORDER BY key'
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        for key, value in rows:
+            yield key, self._load(key, value)
+
+    def write_batch(self, puts=None, deletes=None):
+        puts = puts or {}
+        deletes = [key for key in (deletes or []) if key not in puts]
+        with self._lock:
+            try:
+                self._conn.execute('BEGIN')
+                if deletes:
+                    self._conn.executemany('DELETE FROM docs WHERE key = ?',
+                                           [(key,) for key in deletes])
+                if puts:
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO docs (key, value) VALUES (?, ?)',
+                        [(key, self._dump(doc)) for key, doc in puts.items()])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def find(self, query):
+        selector = query.get('selector', {})
+        return [doc for _, doc in self.scan() if match_selector(selector, doc)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_engine(name, db_url=None, db_name='block_chain', db_path=None):
+    if name == 'couchdb':
+        return CouchDBEngine(db_url, db_name)
+    if name == 'sqlite':
+        return SQLiteEngine(db_path or db_name + '.db')
+    raise ValueError('unknown storage engine: %s' % name)
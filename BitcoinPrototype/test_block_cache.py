@@ -0,0 +1,10 @@
+# coding:utf-8
+
+def test_height_miss_counts_once(chain):
+    db, bc = chain
+    bc.cache.clear()
+    hits, misses = bc.cache.hits, bc.cache.misses
+    bc.get_block_by_height(1)
+    assert (bc.cache.hits, bc.cache.misses) == (hits, misses + 1)
+    bc.get_block_by_height(1)
+    assert (bc.cache.hits, bc.cache.misses) == (hits + 1, misses + 1)
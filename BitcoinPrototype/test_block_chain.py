@@ -0,0 +1,64 @@
+# coding:utf-8
+
+def test_block_by_height_out_of_range(chain):
+    db, bc = chain
+    last_height = bc.get_last_height()
+    assert bc.get_block_by_height(last_height).block_header.height == last_height
+    assert bc.get_block_hash_by_height(-1) is None
+    assert bc.get_block_hash_by_height(last_height + 1) is None
+
+def test_legacy_chain_is_indexed_once(chain):
+    db, bc = chain
+    last_height = bc.get_last_height()
+    hashes = [bc.get_block_hash_by_height(h) for h in range(last_height + 1)]
+    # a chain stored before the height index existed
+    db.write_batch(puts={"l": {"hash": hashes[-1]}},
+                   deletes=[bc._height_key(h) for h in range(last_height + 1)])
+    bc.cache.clear()
+    assert bc.get_block_hash_by_height(1) == hashes[1]
+    assert db.get("l")["height"] == last_height
+    assert all(db.get(bc._height_key(h)) for h in range(last_height + 1))
+
+def test_one_mined_block_per_parent(chain, address, mempool):
+    import contextlib
+    import io
+    import threading
+    db, bc = chain
+    height = bc.get_last_height()
+    tx = bc.new_transaction(address, address, 1)
+    blocks = [bc.new_block_template([]), bc.new_block_template([tx])]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for block in blocks:
+            block.mine(bc)
+            block.set_header_hash()
+    barrier = threading.Barrier(len(blocks))
+    results = []
+    def connect(block):
+        barrier.wait()
+        results.append(bc.add_mined_block(block))
+    threads = [threading.Thread(target=connect, args=(block,)) for block in blocks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == [False, True]
+    assert bc.get_last_height() == height + 1
+
+def test_block_timestamp_bounds(chain):
+    import time
+    from conf import max_future_block_time
+    db, bc = chain
+    tip = bc.get_last_block()
+    block = bc.new_block_template([])
+    assert block.check_timestamp(bc)
+
+    block.block_header.timestamp = str(time.time() + max_future_block_time + 60)
+    assert not block.check_timestamp(bc)
+    assert not block.validate(bc)
+
+    # not later than the median time of the blocks before it
+    block.block_header.timestamp = str(bc.median_time_past(tip))
+    assert not block.check_timestamp(bc)
+    assert not block.validate(bc)
+    block.block_header.timestamp = str(float(tip.block_header.timestamp) - 3600)
+    assert not block.validate(bc)
@@ -0,0 +1,103 @@
+# coding:utf-8
+import contextlib
+import io
+
+import pytest
+
+import codec
+from transactions import TXInput, TXOutput, Transaction
+
+ADDRESS = "1BoatSLRHtKNngkdXEeobR76b53LETtpyT"
+
+def unsigned_tx():
+    vins = [TXInput("ab" * 32, 0, "cd" * 64), TXInput("ef" * 32, 3, "cd" * 64)]
+    vouts = [TXOutput(10, ADDRESS), TXOutput(990, "12" * 20)]
+    tx = Transaction(vins, vouts)
+    tx.set_id()
+    return tx
+
+def sample_txs():
+    signed = unsigned_tx()
+    for vin in signed.vins:
+        vin.signature = "99" * 64
+    return [Transaction.coinbase_tx(ADDRESS, "reward data"), unsigned_tx(), signed]
+
+@pytest.mark.parametrize("tx", sample_txs())
+def test_tx_round_trip(tx):
+    data = codec.encode_tx(tx)
+    decoded = codec.decode_tx(data)
+    assert decoded.serialize() == tx.serialize()
+    assert decoded.txid == tx.txid
+    assert decoded.check_txid()
+    assert decoded.raw_bytes() == data
+    # the bytes seeded from the wire are the ones computed from the fields
+    assert decoded.id_bytes() == codec.encode_tx_id(decoded)
+
+@pytest.mark.parametrize("name", ["json", "binary"])
+def test_pack_tx_round_trip(name):
+    for tx in sample_txs():
+        assert codec.unpack_tx(codec.pack_tx(tx, codec=name)).serialize() == tx.serialize()
+
+def test_block_round_trip(chain, address):
+    db, bc = chain
+    # a block with a spending transaction, mined but not connected
+    block = bc.new_block_template([bc.new_transaction(address, address, 1)])
+    with contextlib.redirect_stdout(io.StringIO()):
+        block.mine(bc)
+    block.set_header_hash()
+    blocks = [bc.get_block_by_height(0), bc.get_last_block(), block]
+    for block in blocks:
+        decoded = codec.decode_block(codec.encode_block(block))
+        assert decoded.serialize() == block.serialize()
+        for name in ("json", "binary"):
+            assert codec.unpack_block(codec.pack_block(block, codec=name)).serialize() == block.serialize()
+
+def test_unknown_version():
+    data = codec.encode_tx(unsigned_tx())
+    with pytest.raises(ValueError):
+        codec.decode_tx(bytes((codec.VERSION + 1,)) + data[1:])
+
+def test_unknown_block_version(chain):
+    db, bc = chain
+    data = codec.encode_block(bc.get_last_block())
+    with pytest.raises(ValueError):
+        codec.decode_block(bytes((codec.BLOCK_VERSION + 1,)) + data[1:])
+
+def test_truncated_input(chain):
+    db, bc = chain
+    for data, decode in [(codec.encode_tx(sample_txs()[2]), codec.decode_tx),
+                         (codec.encode_block(bc.get_last_block()), codec.decode_block)]:
+        for size in range(len(data)):
+            with pytest.raises(ValueError):
+                decode(data[:size])
+
+def test_truncated_stream():
+    stream = io.BytesIO()
+    codec.write_tx(stream, unsigned_tx())
+    data = stream.getvalue()
+    assert codec.read_tx(io.BytesIO(data)).serialize() == unsigned_tx().serialize()
+    assert codec.read_tx(io.BytesIO(b"")) is None
+    with pytest.raises(ValueError):
+        codec.read_tx(io.BytesIO(data[:-1]))
+
+def test_txid_ignores_signatures():
+    tx = unsigned_tx()
+    txid, id_bytes, raw = tx.txid, tx.id_bytes(), tx.raw_bytes()
+    tx.vins[0].signature = "77" * 64
+    assert tx.id_bytes() == id_bytes
+    assert tx.txid == txid
+    assert tx.raw_bytes() != raw
+    assert codec.decode_tx(tx.raw_bytes()).vins[0].signature == "77" * 64
+
+def test_txid_follows_the_fields():
+    tx = unsigned_tx()
+    txid, id_bytes, raw = tx.txid, tx.id_bytes(), tx.raw_bytes()
+    tx.vouts[0].value = 11
+    assert tx.id_bytes() != id_bytes
+    assert tx.raw_bytes() != raw
+    tx.set_id()
+    assert tx.txid != txid
+    assert tx.id_bytes() == codec.encode_tx_id(tx)
+    tx.vouts[0].value = 10
+    tx.set_id()
+    assert (tx.txid, tx.id_bytes()) == (txid, id_bytes)
@@ -0,0 +1,23 @@
+# coding:utf-8
+import time
+
+def test_invalid_template_drops_bad_transactions(chain, address, mempool):
+    from miner import Miner
+    db, bc = chain
+    good = bc.new_transaction(address, address, 1)
+    mempool.add(good)
+    bad = bc.new_transaction(address, address, 1)
+    signature = bad.vins[0].signature
+    bad.vins[0].signature = signature[:-2] + ("00" if signature[-2:] != "00" else "11")
+    # slipped past admission, e.g. by a bug
+    mempool._insert(bad, 0)
+    miner = Miner()
+    height = bc.get_last_height()
+    miner.submit(bc.new_block_template(mempool.select()))
+    deadline = time.time() + 10
+    while miner.busy and time.time() < deadline:
+        time.sleep(0.01)
+    assert not miner.busy
+    assert bad.txid not in mempool
+    assert good.txid in mempool
+    assert bc.get_last_height() == height
@@ -0,0 +1,47 @@
+# coding:utf-8
+import pytest
+
+from storage import SQLiteEngine
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = SQLiteEngine(str(tmp_path / "storage.db"))
+    yield engine
+    engine.close()
+
+def keys(engine, **kwargs):
+    return [key for key, _ in engine.scan(**kwargs)]
+
+def test_failed_batch_writes_nothing(engine):
+    engine.write_batch(puts={"keep": {"v": 1}, "old": {"v": 2}})
+    # the document cannot be encoded, after the deletes ran
+    with pytest.raises(TypeError):
+        engine.write_batch(puts={"new": {"v": 3}, "bad": {"v": object()}},
+                           deletes=["old"])
+    # the second row breaks the primary key, after the first was written
+    with pytest.raises(Exception):
+        engine.write_batch(puts={"new": {"v": 3}, None: {"v": 4}}, deletes=["old"])
+    assert keys(engine) == ["keep", "old"]
+    assert engine.get("old")["v"] == 2
+    assert engine.get("new") is None
+    # the engine is still usable
+    engine.write_batch(puts={"new": {"v": 3}}, deletes=["old"])
+    assert keys(engine) == ["keep", "new"]
+
+def test_scan_prefix_boundaries(engine):
+    names = ["UTX", "UTXN\uffff", "UTXO", "UTXO-1", "UTXOl", "UTXO\uffff", "UTXP", "UTXPa", "utxo"]
+    engine.write_batch(puts=dict((name, {"name": name}) for name in names))
+    assert keys(engine, prefix="UTXO") == ["UTXO", "UTXO-1", "UTXOl", "UTXO\uffff"]
+    assert [doc["name"] for _, doc in engine.scan("UTXO")] == keys(engine, prefix="UTXO")
+    assert keys(engine, prefix="UTXP") == ["UTXP", "UTXPa"]
+    assert keys(engine, prefix="X") == []
+    assert keys(engine) == sorted(names)
+
+def test_scan_range_inside_prefix(engine):
+    engine.write_batch(puts=dict(("H%010d" % height, {"height": height}) for height in range(20)))
+    engine.put("Hz", {})
+    engine.put("I", {})
+    assert keys(engine, prefix="H", start="H%010d" % 5, end="H%010d" % 8) == \
+        ["H%010d" % height for height in range(5, 8)]
+    assert keys(engine, prefix="H", start="H%010d" % 18) == ["H0000000018", "H0000000019", "Hz"]
+    assert keys(engine, prefix="H", start="A") == keys(engine, prefix="H")
@@ -0,0 +1,44 @@
+# coding:utf-8
+import pytest
+
+from transactions import Transaction
+
+# Written by the node before the binary codec, the txid hashed the JSON
+LEGACY_TXS = [
+    {"txid": "ad99a92c85accafc2b8945f42ecfd838e93acb098df01788f93ef6f975ab43d2",
+     "vins": [{"txid": "", "vout": -1, "signature": "", "pub_key": "genesis"}],
+     "vouts": [{"value": 1000, "pub_key_hash": "1BoatSLRHtKNngkdXEeobR76b53LETtpyT"}]},
+    {"txid": "ac9dc8e50c5a75ba336d5f6b28cb6d990679abfddd4da51d77290dc352975224",
+     "vins": [{"txid": "ad99a92c85accafc2b8945f42ecfd838e93acb098df01788f93ef6f975ab43d2",
+               "vout": 0, "signature": "cd" * 64, "pub_key": "ab" * 64}],
+     "vouts": [{"value": 10, "pub_key_hash": "1BoatSLRHtKNngkdXEeobR76b53LETtpyT"},
+               {"value": 990, "pub_key_hash": "1Boat"}]},
+]
+
+@pytest.mark.parametrize("data", LEGACY_TXS)
+def test_legacy_txid(data):
+    tx = Transaction.deserialize(data)
+    assert tx.check_txid()
+    assert tx.txid == data["txid"]
+
+def test_txid_of_another_transaction(chain, address, mempool):
+    from errors import TransactionRejectedError
+    db, bc = chain
+    tx = bc.new_transaction(address, address, 1)
+    assert tx.check_txid()
+    other = bc.get_last_block().transactions[0]
+    forged = Transaction.deserialize(dict(tx.serialize(), txid=other.txid))
+    assert not forged.check_txid()
+    with pytest.raises(TransactionRejectedError):
+        mempool.add(forged)
+    assert other.txid not in mempool
+
+def test_block_with_forged_txid(chain, address):
+    db, bc = chain
+    tx = bc.new_transaction(address, address, 1)
+    block = bc.new_block_template([tx])
+    other = bc.get_last_block().transactions[0]
+    block.transactions[1].txid = other.txid
+    block.block_header.hash_merkle_root = block.compute_merkle_root()
+    assert block.check_merkle_root()
+    assert not block.validate(bc)
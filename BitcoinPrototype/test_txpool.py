@@ -0,0 +1,54 @@
+# coding:utf-8
+import os
+
+import pytest
+
+from txpool import Mempool
+
+@pytest.mark.parametrize("data", [b"garbage", b"MEMPOOL\x01" + b"\0" * 8 + b"\x05ab"])
+def test_load_damaged_snapshot(tmp_path, data):
+    path = str(tmp_path / "mempool.dat")
+    with open(path, "wb") as f:
+        f.write(data)
+    mempool = Mempool()
+    assert mempool.load(path) == 0
+    assert len(mempool) == 0
+    assert not os.path.exists(path)
+    assert os.path.exists(path + ".bad")
+
+def test_add_many_rechecks_outputs_spent_meanwhile(chain, address, mempool, monkeypatch):
+    import contextlib
+    import io
+    from sigverify import SignatureVerifier
+    db, bc = chain
+    tx = bc.new_transaction(address, address, 1)
+    conflict = bc.new_transaction(address, address, 2)
+    verifier = SignatureVerifier.get()
+    verify_each = verifier.verify_each
+    def connect_conflict(checks):
+        # a block spending the same output connects during the signature pass
+        with contextlib.redirect_stdout(io.StringIO()):
+            bc.add_block([conflict])
+        return verify_each(checks)
+    monkeypatch.setattr(verifier, "verify_each", connect_conflict)
+    assert mempool.add_many([tx]) == []
+    assert tx.txid not in mempool
+
+def test_roll_back_evicts_spenders_of_the_block(chain, address, mempool):
+    import contextlib
+    import io
+    from utxo import UTXOSet
+    db, bc = chain
+    with contextlib.redirect_stdout(io.StringIO()):
+        bc.add_block([])
+    block = bc.get_last_block()
+    coinbase = block.transactions[0]
+    # spend the new block's coinbase, then drop the block
+    balance = sum(utxo.txoutput.value for utxo in UTXOSet().find_utxo(address))
+    tx = bc.new_transaction(address, address, balance)
+    assert any(vin.txid == coinbase.txid for vin in tx.vins)
+    mempool.add(tx)
+    UTXOSet().roll_back(block)
+    bc.roll_back()
+    assert tx.txid not in mempool
+    assert mempool.spent_outpoints() == set()
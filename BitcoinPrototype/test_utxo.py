@@ -0,0 +1,27 @@
+# coding:utf-8
+
+def test_reindex_from_scratch(chain):
+    from utxo import UTXOSet
+    db, bc = chain
+    utxo_set = UTXOSet()
+    utxo_set.flush()
+    # drop the UTXO set as if it was never built
+    stale = [key for key, _ in db.scan(UTXOSet.FLAG)]
+    stale += [key for key, _ in db.scan(UTXOSet.ADDR_FLAG)]
+    db.write_batch(deletes=stale)
+    utxo_set.cache.clear()
+
+    utxo_set.reindex(bc)
+
+    last_height = bc.get_last_height()
+    assert db.get(UTXOSet.FLAG + "l")["height"] == last_height
+    coins = [(txid, index, vout) for txid, index_vouts in bc.find_UTXO().items()
+             for index, vout in index_vouts]
+    assert coins
+    outputs = utxo_set.get_outputs([(txid, index) for txid, index, _ in coins])
+    assert len(outputs) == len(coins)
+    for txid, index, vout in coins:
+        doc = db.get(utxo_set._key(txid, index))
+        assert "height" not in doc
+        assert outputs[(txid, index)].value == vout.value
+        assert outputs[(txid, index)].pub_key_hash == vout.pub_key_hash
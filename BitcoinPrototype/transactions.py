@@ -11,12 +11,25 @@ The output of the transaction is where the currency is actually stored.
 """
 
 import binascii
-import ecdsa
+import hashlib
+import crypto
 from utils import sum256_hex, hash_public_key, address_to_pubkey_hash
+from sigcache import SignatureCache
 
 # For convenience, set the subsidy to 1000
 subsidy = 1000
 
+def verify_signature(sighash, pub_key, signature):
+    """
+    Check one input signature, sighash is the signed message and
+    pub_key/signature are hex strings. Malformed keys or signatures
+    count as a failed check.
+    """
+    try:
+        return crypto.verify(binascii.a2b_hex(pub_key), binascii.unhexlify(signature), sighash)
+    except (binascii.Error, ValueError, TypeError, AssertionError):
+        return False
+
 """Transaction output structurecontains the destination address and the amount"""
 class TXOutput(object):
     def __init__(self, value, pub_key_hash=''):
@@ -27,13 +40,17 @@ class TXOutput(object):
         hex_pub_key_hash = binascii.hexlify(address_to_pubkey_hash(address))
         self.pub_key_hash = hex_pub_key_hash
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        _changed(self, name)
+
     # Used to check the address belonging
     def is_locked_with_key(self, pub_key_hash):
         return self.pub_key_hash == pub_key_hash
 
     # Serialize to the dictionary for indexing, json
     def serialize(self):
-        return self.__dict__
+        return {'value': self.value, 'pub_key_hash': self.pub_key_hash}
 
     def __repr__(self):
         return 'TXOutput(value={value}, pub_key_hash={pub_key_hash})'.format(
@@ -54,6 +71,10 @@ class TXInput(object):
         self.signature = ''
         self.pub_key = pub_key
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        _changed(self, name)
+
     # check the address(pkhash)
     def use_key(self, pub_key_hash):
         bin_pub_key = binascii.unhexlify(self.pub_key)
@@ -62,7 +83,8 @@ class TXInput(object):
 
     # Serialize to the dictionary for indexing, json
     def serialize(self):
-        return self.__dict__
+        return {'txid': self.txid, 'vout': self.vout,
+                'signature': self.signature, 'pub_key': self.pub_key}
 
     def __repr__(self):
         return 'TXInput(txid={txid}, vout={vout})'.format(
@@ -78,22 +100,90 @@ class TXInput(object):
         tx_input.signature = signature
         return tx_input
 
+def _changed(item, name):
+    # Inputs and outputs tell their transaction when a field changes
+    tx = item.__dict__.get('_tx')
+    if tx is not None:
+        tx._changed(name)
+
 """To construct a transaction txinput||txoutput, 
-    and generate a txid with hashing them."""
+    and generate a txid with hashing them.
+    The txid is the hash of the canonical bytes of the transaction (see
+    codec.encode_tx_id), which leave the signatures out so signing does not
+    change it. The bytes and the txid are computed once and cached until a
+    field of the transaction, its inputs or its outputs is assigned. Lists
+    edited in place are not seen, call set_id() after such edits."""
 class Transaction(object):
     def __init__(self, vins, vouts):
-        self.txid = ''
+        self._txid = None
+        self._id_bytes = None
+        self._raw = None
         self.vins = vins
         self.vouts = vouts
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in ('vins', 'vouts'):
+            for item in value:
+                item.__dict__['_tx'] = self
+            self._changed(name)
+
+    def _changed(self, name):
+        self._raw = None
+        if name != 'signature':
+            self._id_bytes = None
+            self._txid = None
+
+    @property
+    def txid(self):
+        if self._txid is None:
+            self._txid = sum256_hex(self.id_bytes())
+        return self._txid
+
+    @txid.setter
+    def txid(self, txid):
+        # a txid loaded with the transaction is kept as is, check_txid
+        # tells if it matches, data from peers must be checked
+        self._txid = txid or None
+        self._raw = None
+
+    def id_bytes(self):
+        """The canonical bytes the txid is the hash of"""
+        if self._id_bytes is None:
+            from codec import encode_tx_id
+            self._id_bytes = encode_tx_id(self)
+        return self._id_bytes
+
+    def raw_bytes(self):
+        """The binary encoding of the whole transaction, signatures included"""
+        if self._raw is None:
+            from codec import _encode_tx
+            self._raw = _encode_tx(self)
+        return self._raw
+
+    def _cache_encoding(self, id_bytes, raw):
+        self._id_bytes = id_bytes
+        self._raw = raw
+
+    def legacy_txid(self):
+        """The txid of the transactions made before the binary codec"""
+        data_list = [str({'txid': vin.txid, 'vout': vin.vout, 'signature': '',
+                          'pub_key': vin.pub_key}) for vin in self.vins]
+        data_list.extend(str(vout.serialize()) for vout in self.vouts)
+        return sum256_hex(''.join(data_list))
+
+    def check_txid(self):
+        """
+        Check the txid is the hash of the transaction, either the canonical
+        one or the one of older transactions
+        """
+        txid = self.txid
+        return txid == sum256_hex(self.id_bytes()) or txid == self.legacy_txid()
+
     # Generation of the transaction id
     def set_id(self):
-        data_list = [str(vin.serialize()) for vin in self.vins]
-        vouts_list = [str(vout.serialize()) for vout in self.vouts]
-        data_list.extend(vouts_list)
-        data = ''.join(data_list)
-        hash = sum256_hex(data) # Hash(txinput||txoutput) get the txid
-        self.txid = hash
+        self._changed('txid')
+        self._txid = sum256_hex(self.id_bytes()) # Hash(txinput||txoutput) get the txid
 
     # If the transaction is coinbase transaction(mining reward), it will not have input.
     def is_coinbase(self):
@@ -162,48 +252,71 @@ class Transaction(object):
         We use ECDSA to generate a keypair, 
         private key for signing and public key for verification.
     """
-    def sign(self, priv_key, prev_txs):
-        if self.is_coinbase():
-            return
+    def sighashes(self, prev_outputs):
+        """
+        prev_outputs maps the (txid, vout) outpoint of every input to the
+        TXOutput it spends, see UTXOSet.get_outputs.
+        The message signed by every input: the id of the trimmed copy in
+        which that input carries the public key hash it spends, the inputs
+        before it have signature None and the ones after it signature ''.
+        The inputs and outputs are serialized once, the hash state of the
+        inputs before is carried along and the part after is fed from one
+        buffer, so no input is stringified more than twice.
+        """
+        prev_pub_key_hashes = []
+        for vin in self.vins:
+            prev_output = prev_outputs.get((vin.txid, vin.vout), None)
+            if not prev_output:
+                raise ValueError('Previous output is missing or spent')
+            prev_pub_key_hashes.append(prev_output.pub_key_hash)
+
         tx_copy = self._trimmed_copy()
+        tail = [str(vin.serialize()).encode() for vin in tx_copy.vins]
+        tail.extend(str(vout.serialize()).encode() for vout in tx_copy.vouts)
+        # offsets[i] is where the part following input i starts
+        offsets = [0]
+        for part in tail:
+            offsets.append(offsets[-1] + len(part))
+        tail = memoryview(b''.join(tail))
+
+        head = hashlib.sha256()
+        sighashes = []
+        for in_id, vin in enumerate(tx_copy.vins):
+            vin.signature = None
+            vin.pub_key = prev_pub_key_hashes[in_id]
+            m = head.copy()
+            m.update(str(vin.serialize()).encode())
+            m.update(tail[offsets[in_id+1]:])
+            sighashes.append(m.hexdigest())
+            vin.pub_key = None
+            head.update(str(vin.serialize()).encode())
+        return sighashes
 
-        for in_id, vin in enumerate(tx_copy.vins): # Iterate over each input in the copy
-            prev_tx = prev_txs.get(vin.txid, None)
-            if not prev_tx:
-                raise ValueError('Previous transaction is error')
-            # All transactions are set to "empty" except the current one,
-            # and the Inputs are signed separately
-            tx_copy.vins[in_id].signature = None
-            tx_copy.vins[in_id].pub_key = prev_tx.vouts[vin.vout].pub_key_hash
-            tx_copy.set_id() # the hash result is the data we want to sign
-            tx_copy.vins[in_id].pub_key = None # reset
-
-            # Use the private key to sign for the transaction.
-            sk = ecdsa.SigningKey.from_string(
-                binascii.a2b_hex(priv_key), curve=ecdsa.SECP256k1)
-            sign = sk.sign(tx_copy.txid.encode())
+    def sign(self, priv_key, prev_outputs):
+        if self.is_coinbase():
+            return
+        # Use the private key to sign every input of the transaction.
+        private_key = binascii.a2b_hex(priv_key)
+        for in_id, sighash in enumerate(self.sighashes(prev_outputs)):
+            sign = crypto.sign(private_key, sighash.encode())
             self.vins[in_id].signature = binascii.hexlify(sign).decode()
 
-    def verify(self, prev_txs):
+    def signature_checks(self, prev_outputs):
+        """
+        The (sighash, pub_key, signature) triple of every input,
+        each one can be verified on its own with verify_signature.
+        """
         if self.is_coinbase():
-            return True
-        tx_copy = self._trimmed_copy()
+            return []
+        return [(sighash.encode(), vin.pub_key, vin.signature)
+                for vin, sighash in zip(self.vins, self.sighashes(prev_outputs))]
 
-        # is similar with the sign procedure
-        for in_id, vin in enumerate(self.vins):
-            prev_tx = prev_txs.get(vin.txid, None)
-            if not prev_tx:
-                raise ValueError('Previous transaction is error')
-            tx_copy.vins[in_id].signature = None
-            tx_copy.vins[in_id].pub_key = prev_tx.vouts[vin.vout].pub_key_hash
-            tx_copy.set_id()
-            tx_copy.vins[in_id].pub_key = None
-
-            # Unhex the signature for verification
-            sign = binascii.unhexlify(self.vins[in_id].signature)
-            # use the public key to verify the signature
-            vk = ecdsa.VerifyingKey.from_string(
-                binascii.a2b_hex(vin.pub_key), curve=ecdsa.SECP256k1)
-            if not vk.verify(sign, tx_copy.txid.encode()):
+    def verify(self, prev_outputs):
+        cache = SignatureCache()
+        for check in self.signature_checks(prev_outputs):
+            if cache.contains(check):
+                continue
+            if not verify_signature(*check):
                 return False # reject the transaction
+            cache.add(check)
         return True
\ No newline at end of file
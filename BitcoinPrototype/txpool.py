@@ -1,20 +1,414 @@
 # coding:utf-8
+"""
+The pool of transactions waiting for a block.
+Transactions are checked once when they are admitted: their inputs must be
+unspent in the UTXO set and not claimed by another pool transaction, the
+outputs must not be worth more than the inputs and the signatures must be
+valid. Any subset of the pool is then a valid set of block transactions.
+The pool is indexed by txid and by spent outpoint, ordered by fee rate
+then arrival, bounded in bytes and in age.
+
+The pool is written to a snapshot file from time to time and when the
+process exits, and read back at startup. The file holds a magic header
+then one entry per transaction:
+    arrival time(f64) length(varint) transaction(binary codec)
+Loaded transactions are checked again against the current UTXO set.
+"""
+import atexit
+import heapq
+import itertools
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
 from utils import Singleton
+from utxo import UTXOSet
+from sigcache import SignatureCache
+from sigverify import SignatureVerifier
+from errors import TransactionRejectedError
+from conf import mempool_max_bytes, mempool_expiry, mempool_snapshot, mempool_snapshot_interval
+
+_SNAPSHOT_MAGIC = b'MEMPOOL\x01'
+
+class MempoolEntry(object):
+    def __init__(self, tx, fee, size, seq, arrival=None):
+        self.tx = tx
+        self.fee = fee
+        self.size = size
+        self.seq = seq
+        self.time = arrival or time.time()
+
+    @property
+    def fee_rate(self):
+        return self.fee / self.size
+
+    def sort_key(self):
+        # best first: higher fee rate, then the older one
+        return (-self.fee_rate, self.seq)
+
+class Mempool(Singleton):
+    """Unconfirmed transactions
+    Attributes:
+        max_bytes (int): Encoded size the pool may hold, the lowest fee rate
+            transactions are evicted above it.
+        expiry (int): Seconds a transaction may wait before it is dropped.
+    """
+    def __init__(self, max_bytes=mempool_max_bytes, expiry=mempool_expiry):
+        if hasattr(self, '_entries'):
+            return
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self._lock = threading.RLock()
+        # txid -> entry, in arrival order
+        self._entries = OrderedDict()
+        # (txid, vout) spent by a pool transaction -> its txid
+        self._spenders = {}
+        # eviction candidates, worst first, stale items are skipped
+        self._eviction = []
+        self._seq = itertools.count()
+        self.bytes = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.expired = 0
+        # bumped on every change, the snapshot is skipped when nothing moved
+        self._version = 0
+        self._saved_version = 0
+        self._snapshot_thread = None
+
+    def __len__(self):
+        return len(self._entries)
 
-class TxPool(Singleton):
-    SIZE = 2
-    def __init__(self):
-        if not hasattr(self, "txs"):
-            self.txs = []
+    def __contains__(self, txid):
+        return txid in self._entries
 
-    # To check if the pool is full, if so, return True, else return False
-    def is_full(self):
-        return len(self.txs) >= self.SIZE
+    def get(self, txid):
+        entry = self._entries.get(txid)
+        return entry.tx if entry else None
+
+    @property
+    def txs(self):
+        with self._lock:
+            return [entry.tx for entry in self._entries.values()]
+
+    def spender(self, outpoint):
+        """txid of the pool transaction spending outpoint, None if there is none"""
+        return self._spenders.get(outpoint)
+
+    def spent_outpoints(self):
+        with self._lock:
+            return set(self._spenders)
+
+    def oldest_time(self):
+        """Arrival time of the transaction waiting the longest, None if empty"""
+        with self._lock:
+            for entry in self._entries.values():
+                return entry.time
+        return None
 
-    # tx:the transaction
-    #add transaction in the pool
     def add(self, tx):
-        self.txs.append(tx)
+        """
+        Admit tx, raise TransactionRejectedError if it is not valid
+        """
+        try:
+            with self._lock:
+                self._add(tx)
+            self.accepted += 1
+        except TransactionRejectedError:
+            self.rejected += 1
+            raise
+
+    def _add(self, tx):
+        self.expire()
+        outpoints = [(vin.txid, vin.vout) for vin in tx.vins]
+        prev_outputs, fee = self._check(tx, UTXOSet().get_outputs(outpoints))
+        if not tx.verify(prev_outputs):
+            raise TransactionRejectedError('transaction verify error')
+        self._insert(tx, fee)
+        if tx.txid not in self._entries:
+            raise TransactionRejectedError('mempool is full')
+
+    def _check(self, tx, utxo_outputs, claimed=()):
+        """
+        Everything but the signatures, utxo_outputs holds at least the
+        outputs tx spends that are unspent. Returns the spent outputs and
+        the fee.
+        """
+        if tx.txid in self._entries:
+            raise TransactionRejectedError('transaction already in the pool: %s' % tx.txid)
+        if tx.is_coinbase():
+            raise TransactionRejectedError('coinbase transaction')
+        if not tx.check_txid():
+            raise TransactionRejectedError('txid does not match the transaction: %s' % tx.txid)
+        outpoints = [(vin.txid, vin.vout) for vin in tx.vins]
+        if len(set(outpoints)) != len(outpoints):
+            raise TransactionRejectedError('transaction spends an output twice')
+        prev_outputs = {}
+        for outpoint in outpoints:
+            spender = self._spenders.get(outpoint)
+            if spender:
+                raise TransactionRejectedError('output %s-%d is spent by %s'
+                                               % (outpoint[0], outpoint[1], spender))
+            if outpoint in claimed or outpoint not in utxo_outputs:
+                raise TransactionRejectedError('transaction spends a missing or spent output')
+            prev_outputs[outpoint] = utxo_outputs[outpoint]
+        fee = sum(out.value for out in prev_outputs.values()) - sum(out.value for out in tx.vouts)
+        if fee < 0 or any(out.value < 0 for out in tx.vouts):
+            raise TransactionRejectedError('outputs are worth more than the inputs')
+        return prev_outputs, fee
+
+    def _insert(self, tx, fee, arrival=None):
+        entry = MempoolEntry(tx, fee, len(tx.raw_bytes()), next(self._seq), arrival)
+        self._entries[tx.txid] = entry
+        for vin in tx.vins:
+            self._spenders[(vin.txid, vin.vout)] = tx.txid
+        self.bytes += entry.size
+        self._version += 1
+        heapq.heappush(self._eviction, (entry.fee_rate, -entry.seq, tx.txid))
+        self._trim()
+
+    def add_many(self, txs, arrivals=None):
+        """
+        Admit several transactions at once, the outputs they spend are
+        fetched in one multi-get and their signatures checked in one pass
+        over the signature verifier. The pool is locked only to check the
+        outputs again and insert them. Rejected transactions are skipped,
+        returns the admitted ones.
+        """
+        txs = list(txs)
+        arrivals = arrivals or [None] * len(txs)
+        outpoints = [(vin.txid, vin.vout) for tx in txs for vin in tx.vins]
+        utxo_outputs = UTXOSet().get_outputs(outpoints)
+        self.expire()
+        # the checks run without the lock, the pool is only read
+        candidates = []
+        claimed = set()
+        for tx, arrival in zip(txs, arrivals):
+            try:
+                prev_outputs, fee = self._check(tx, utxo_outputs, claimed)
+            except TransactionRejectedError:
+                self.rejected += 1
+                continue
+            claimed.update(prev_outputs)
+            candidates.append((tx, prev_outputs, fee, arrival))
+
+        # one result per check, so a bad transaction only drops itself
+        cache = SignatureCache()
+        tx_checks = [cache.missing(tx.signature_checks(prev_outputs))
+                     for tx, prev_outputs, _, _ in candidates]
+        results = iter(SignatureVerifier.get().verify_each(
+            [check for checks in tx_checks for check in checks]))
+        valid = []
+        for candidate, checks in zip(candidates, tx_checks):
+            if all([next(results) for _ in checks]):
+                cache.add_many(checks)
+                valid.append(candidate)
+        self.rejected += len(candidates) - len(valid)
+        candidates = valid
+
+        admitted = []
+        with self._lock:
+            # a block may have spent some outputs since the first fetch,
+            # like _add the final checks read the UTXO set under the lock
+            utxo_outputs = UTXOSet().get_outputs(
+                [outpoint for _, prev_outputs, _, _ in candidates for outpoint in prev_outputs])
+            claimed = set()
+            for tx, _, fee, arrival in candidates:
+                # the pool may have changed since the checks
+                try:
+                    prev_outputs, _ = self._check(tx, utxo_outputs, claimed)
+                except TransactionRejectedError:
+                    self.rejected += 1
+                    continue
+                claimed.update(prev_outputs)
+                self._insert(tx, fee, arrival)
+            admitted = [tx for tx, _, _, _ in candidates if tx.txid in self._entries]
+            self.accepted += len(admitted)
+            self.expire()
+        return admitted
+
+    def remove(self, txids):
+        """
+        Drop the transactions txids, e.g. ones a block template failed on
+        """
+        with self._lock:
+            return [txid for txid in txids if self._remove(txid)]
+
+    def _remove(self, txid):
+        entry = self._entries.pop(txid, None)
+        if entry is None:
+            return None
+        for vin in entry.tx.vins:
+            self._spenders.pop((vin.txid, vin.vout), None)
+        self.bytes -= entry.size
+        self._version += 1
+        return entry
+
+    def _trim(self):
+        # evict the lowest fee rate, newest first, until the pool fits
+        while self.bytes > self.max_bytes and self._eviction:
+            _, _, txid = heapq.heappop(self._eviction)
+            if self._remove(txid):
+                self.evicted += 1
+        if len(self._eviction) > 2 * len(self._entries) + 64:
+            # drop the stale items left by removed transactions
+            self._eviction = [item for item in self._eviction if item[2] in self._entries]
+            heapq.heapify(self._eviction)
+
+    def expire(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            while self._entries:
+                txid, entry = next(iter(self._entries.items()))
+                if now - entry.time < self.expiry:
+                    break
+                self._remove(txid)
+                self.expired += 1
+
+    def select(self, max_count=None, max_bytes=None):
+        """
+        The best transactions for a block, by fee rate then arrival
+        """
+        with self._lock:
+            entries = sorted(self._entries.values(), key=MempoolEntry.sort_key)
+        txs = []
+        size = 0
+        for entry in entries:
+            if max_count is not None and len(txs) >= max_count:
+                break
+            if max_bytes is not None and size + entry.size > max_bytes:
+                continue
+            txs.append(entry.tx)
+            size += entry.size
+        return txs
+
+    def remove_for_block(self, block):
+        """
+        Drop the transactions confirmed by block and the ones that
+        conflict with it
+        """
+        with self._lock:
+            for tx in block.transactions:
+                self._remove(tx.txid)
+                if tx.is_coinbase():
+                    continue
+                for vin in tx.vins:
+                    spender = self._spenders.get((vin.txid, vin.vout))
+                    if spender:
+                        self._remove(spender)
+
+    def readd_block(self, block):
+        """
+        Put back the transactions of a block that was rolled back,
+        the ones that are no longer valid are dropped. Pool transactions
+        spending the block's outputs are evicted first, those outputs
+        are gone with it.
+        """
+        txids = set(tx.txid for tx in block.transactions)
+        with self._lock:
+            orphans = set(spender for outpoint, spender in self._spenders.items()
+                          if outpoint[0] in txids)
+            for txid in orphans:
+                self._remove(txid)
+        for tx in block.transactions:
+            if tx.is_coinbase():
+                continue
+            try:
+                self.add(tx)
+            except TransactionRejectedError:
+                pass
+
     # clear all data
     def clear(self):
-        self.txs.clear()
+        with self._lock:
+            self._entries.clear()
+            self._spenders.clear()
+            self._eviction = []
+            self.bytes = 0
+            self._version += 1
+
+    def save(self, path=mempool_snapshot):
+        """
+        Write the pool to path, the previous snapshot is replaced at once
+        so a crash never leaves half a file
+        """
+        import codec
+        with self._lock:
+            entries = list(self._entries.values())
+            version = self._version
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_SNAPSHOT_MAGIC)
+            for entry in entries:
+                f.write(struct.pack('>d', entry.time))
+                codec.write_tx(f, entry.tx)
+        os.replace(tmp, path)
+        self._saved_version = version
+        return len(entries)
+
+    def load(self, path=mempool_snapshot):
+        """
+        Admit the transactions of the snapshot at path, the ones confirmed
+        or conflicting since it was written are dropped. Returns how many
+        were admitted.
+        """
+        import codec
+        txs = []
+        arrivals = []
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+                    raise ValueError('%s is not a mempool snapshot' % path)
+                while True:
+                    arrival = f.read(8)
+                    if not arrival:
+                        break
+                    if len(arrival) != 8:
+                        raise ValueError('unexpected end of data')
+                    arrivals.append(struct.unpack('>d', arrival)[0])
+                    tx = codec.read_tx(f)
+                    if tx is None:
+                        raise ValueError('unexpected end of data')
+                    txs.append(tx)
+        except IOError:
+            return 0
+        except (ValueError, IndexError, struct.error) as e:
+            # a damaged snapshot must not keep the node from starting
+            bad_path = path + '.bad'
+            os.replace(path, bad_path)
+            print('mempool snapshot %s is unreadable (%s), moved to %s' % (path, e, bad_path))
+            return 0
+        admitted = self.add_many(txs, arrivals)
+        self._saved_version = self._version
+        return len(admitted)
+
+    def start_snapshots(self, path=mempool_snapshot, interval=mempool_snapshot_interval):
+        """
+        Save the pool every interval seconds when it changed, and when
+        the process exits
+        """
+        if self._snapshot_thread is not None:
+            return
+        def loop():
+            while True:
+                time.sleep(interval)
+                if self._version != self._saved_version:
+                    self.save(path)
+        self._snapshot_thread = threading.Thread(target=loop, name='mempool-snapshot')
+        self._snapshot_thread.daemon = True
+        self._snapshot_thread.start()
+        atexit.register(self.save, path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "transactions": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
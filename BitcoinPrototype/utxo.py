@@ -14,10 +14,13 @@ This is a cache built from all blockchain transactions (iterating over blocks,
 Through September 2017, the UTXO set is about 2.7 Gb.
 """
 
+import atexit
+import threading
+from collections import OrderedDict
+
 from db import DB, Singleton
 from transactions import TXOutput
-from couchdb import ResourceNotFound, ResourceConflict
-from conf import db_url
+from conf import db_url, utxo_cache_size, utxo_cache_flush_size, utxo_cache_flush_blocks
 
 class FullTXOutput(object):
     def __init__(self, txid, txoutput, index):
@@ -25,123 +28,349 @@ class FullTXOutput(object):
         self.txoutput = txoutput
         self.index = index
 
+def _strip(doc):
+    return dict((k, v) for k, v in doc.items() if not k.startswith('_'))
+
+class CoinsCache(object):
+    """Write-back cache of unspent outputs in front of the database.
+    New outputs and spends stay in memory as dirty entries and are written
+    to storage in one batch by flush(), together with the other pending
+    documents (undo records, height marker).
+    Attributes:
+        max_entries (int): Memory budget, clean entries are evicted above it.
+        flush_size (int): Flush once this many dirty entries are pending.
+        flush_blocks (int): Flush after this many blocks whatever the size.
+    """
+    def __init__(self, db, indexer=None, max_entries=utxo_cache_size,
+                 flush_size=utxo_cache_flush_size, flush_blocks=utxo_cache_flush_blocks):
+        self.db = db
+        # indexer(key, doc) gives the (key, doc) of the secondary index entry
+        self.indexer = indexer
+        self.max_entries = max_entries
+        self.flush_size = flush_size
+        self.flush_blocks = flush_blocks
+        self._coins = OrderedDict()
+        # coins that must be written
+        self._dirty = set()
+        # coins created since the last flush, storage has never seen them
+        self._fresh = set()
+        # spent coins that must be deleted from storage, key -> old doc
+        self._spent = {}
+        self._docs = {}
+        self._deleted_docs = set()
+        self._blocks = 0
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self._spent:
+                self.hits += 1
+                continue
+            doc = self._coins.get(key)
+            if doc is None:
+                missing.append(key)
+                continue
+            self._coins.move_to_end(key)
+            self.hits += 1
+            found[key] = doc
+        self.misses += len(missing)
+        if missing:
+            for key, doc in self.db.get_many(missing).items():
+                doc = _strip(doc)
+                self._coins[key] = doc
+                found[key] = doc
+            self._evict()
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def add(self, key, doc, fresh=True):
+        if key in self._spent:
+            # restored by a roll back before the spend was flushed
+            del self._spent[key]
+            fresh = False
+        self._coins[key] = doc
+        self._coins.move_to_end(key)
+        self._dirty.add(key)
+        if fresh:
+            self._fresh.add(key)
+
+    def spend(self, key, doc):
+        self._coins.pop(key, None)
+        self._dirty.discard(key)
+        if key in self._fresh:
+            # never reached storage, nothing to delete
+            self._fresh.discard(key)
+            return
+        self._spent[key] = doc
+
+    def is_spent(self, key):
+        return key in self._spent
+
+    def dirty_coins(self):
+        return [(key, self._coins[key]) for key in self._dirty]
+
+    def put_doc(self, key, doc):
+        self._deleted_docs.discard(key)
+        self._docs[key] = doc
+
+    def delete_doc(self, key):
+        self._docs.pop(key, None)
+        self._deleted_docs.add(key)
+
+    def get_doc(self, key):
+        if key in self._docs:
+            return self._docs[key]
+        if key in self._deleted_docs:
+            return None
+        return self.db.get(key)
+
+    def block_done(self):
+        self._blocks += 1
+        if len(self._dirty) + len(self._spent) >= self.flush_size \
+                or self._blocks >= self.flush_blocks:
+            self.flush()
+
+    def flush(self):
+        puts = dict(self._docs)
+        for key in self._dirty:
+            puts[key] = self._coins[key]
+        deletes = list(self._spent) + list(self._deleted_docs)
+        if self.indexer:
+            for key in self._dirty:
+                index_key, index_doc = self.indexer(key, self._coins[key])
+                puts[index_key] = index_doc
+            for key, doc in self._spent.items():
+                deletes.append(self.indexer(key, doc)[0])
+        if puts or deletes:
+            self.db.write_batch(puts=puts, deletes=deletes)
+            self.flushes += 1
+        self._dirty.clear()
+        self._fresh.clear()
+        self._spent.clear()
+        self._docs.clear()
+        self._deleted_docs.clear()
+        self._blocks = 0
+        self._evict()
+
+    def clear(self):
+        self._coins.clear()
+        self._dirty.clear()
+        self._fresh.clear()
+        self._spent.clear()
+        self._docs.clear()
+        self._deleted_docs.clear()
+        self._blocks = 0
+
+    def _evict(self):
+        excess = len(self._coins) - self.max_entries
+        if excess <= 0:
+            return
+        # dirty coins stay until the next flush
+        clean = []
+        for key in self._coins:
+            if key not in self._dirty:
+                clean.append(key)
+                if len(clean) >= excess:
+                    break
+        for key in clean:
+            del self._coins[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._coins),
+            "max_entries": self.max_entries,
+            "dirty": len(self._dirty),
+            "spent": len(self._spent),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "flushes": self.flushes,
+        }
+
 """Data structure of UTXO and database settlement"""
 class UTXOSet(Singleton):
     # To distinguish the normal block and UTXO block
     FLAG = 'UTXO'
+    # Undo records, the outputs spent by a block, used by roll_back
+    UNDO_FLAG = 'UNDO'
+    # Address index, address -> unspent outputs
+    ADDR_FLAG = 'ADDR'
     def __init__(self, db_url=db_url):
         if not hasattr(self, 'db'):
             self.db = DB(db_url)
+            self.cache = CoinsCache(self.db, self._address_entry)
+            self._lock = threading.RLock()
+            atexit.register(self.flush)
+
+    def _key(self, txid, index):
+        return self.FLAG + txid + "-" + str(index)
+
+    def _split_key(self, key):
+        txid, index = key[len(self.FLAG):].rsplit("-", 1)
+        return txid, int(index)
+
+    def _address_prefix(self, address):
+        return self.ADDR_FLAG + address + "-"
+
+    # The index entry carries the whole output,
+    # so balance queries never read the coins themselves.
+    def _address_entry(self, key, doc):
+        txid, index = self._split_key(key)
+        index_key = self._address_prefix(doc.get("pub_key_hash", "")) + txid + "-" + str(index)
+        index_doc = dict(doc)
+        index_doc["txid"] = txid
+        return index_key, index_doc
+
+    def _build_address_index(self):
+        """
+        Index the outputs of a UTXO set stored before the address index existed
+        """
+        marker = self.ADDR_FLAG + "l"
+        with self._lock:
+            if self.cache.get_doc(marker):
+                return
+            self.cache.flush()
+            puts = {marker: {"built": True}}
+            for key, doc in self.db.scan(self.FLAG):
+                if doc.get("index") is None:
+                    continue
+                index_key, index_doc = self._address_entry(key, _strip(doc))
+                puts[index_key] = index_doc
+            self.db.write_batch(puts=puts)
+
+    @staticmethod
+    def _vout_doc(vout, index):
+        vout_dict = dict(vout.serialize())
+        vout_dict.update({"index": index})
+        return vout_dict
 
     # Remove the spent output,
     # and add the unspent output from the newly mined transaction.
+    # The changes go to the coins cache, which writes them to storage
+    # in one batch together with the height marker and the undo records.
     def update(self, block):
-        for tx in block.transactions:
-            txid = tx.txid
-            key = self.FLAG + txid
-
-            for vout_index, vout in enumerate(tx.vouts):
-                vout_dict = vout.serialize()
-                vout_dict.update({"index": vout_index})
-                tmp_key = key + "-" +str(vout_index)
-                try: # generate a new UTXO to the database
-                    self.db.create(tmp_key, vout_dict)
-                except ResourceConflict as e:
-                    print(e)
-
-            for vin in tx.vins:
-                vin_txid = vin.txid
-                key = self.FLAG + vin_txid + "-" +str(vin.vout)
-                doc = self.db.get(key)
-                if not doc:
+        with self._lock:
+            created = {}
+            spent_keys = []
+            for tx in block.transactions:
+                for vout_index, vout in enumerate(tx.vouts):
+                    created[self._key(tx.txid, vout_index)] = self._vout_doc(vout, vout_index)
+                if tx.is_coinbase():
                     continue
-                try: # Delete the used UTXO
-                    self.db.delete(doc)
-                except ResourceNotFound as e:
-                    print(e)
-        self.set_last_height(block.block_header.height)
+                for vin in tx.vins:
+                    key = self._key(vin.txid, vin.vout)
+                    # Created and spent inside the same block
+                    if key in created:
+                        del created[key]
+                    else:
+                        spent_keys.append(key)
+
+            spent = self.cache.get_many(spent_keys)
+            undo = []
+            for key in spent_keys:
+                if key in spent:
+                    undo.append([key, spent[key]])
+                    self.cache.spend(key, spent[key])
+            for key, doc in created.items():
+                self.cache.add(key, doc)
+            self.cache.put_doc(self.UNDO_FLAG + block.block_header.hash, {"spent": undo})
+            self.set_last_height(block.block_header.height)
+            self.cache.block_done()
 
     # For safety concern
     def roll_back(self, block):
+        with self._lock:
+            undo_key = self.UNDO_FLAG + block.block_header.hash
+            created = []
+            for tx in block.transactions:
+                for vout_index in range(len(tx.vouts)):
+                    created.append(self._key(tx.txid, vout_index))
+            created_docs = self.cache.get_many(created)
+
+            undo_doc = self.cache.get_doc(undo_key)
+            if undo_doc:
+                restored = dict((key, doc) for key, doc in undo_doc.get("spent", []))
+            else:
+                restored = self._spent_outputs(block, set(created))
+            for key, doc in created_docs.items():
+                if key not in restored:
+                    self.cache.spend(key, doc)
+            for key, doc in restored.items():
+                self.cache.add(key, doc, fresh=False)
+            self.cache.delete_doc(undo_key)
+            self.set_last_height(block.block_header.height-1)
+            # The chain below is about to change, keep storage in step with it
+            self.cache.flush()
+
+    # Blocks connected before undo records existed,
+    # load the spent outputs from the previous transactions instead.
+    def _spent_outputs(self, block, created):
+        from block_chain import BlockChain
+        vins = []
         for tx in block.transactions:
-            txid = tx.txid
-            key = self.FLAG + txid
-            # Delete the UTXO
-            for vout_index, vout in enumerate(tx.vouts):
-                tmp_key = key + "-" +str(vout_index)
-                doc = self.db.get(tmp_key)
-                if not doc:
-                    continue
-                try:
-                    self.db.delete(doc)
-                except ResourceNotFound as e:
-                    print(e)
-            # database in coachDB implementation
+            if tx.is_coinbase():
+                continue
             for vin in tx.vins:
-                vin_txid = vin.txid
-                vout_index = vin.vout
-                key = self.FLAG + vin_txid + "-" +str(vin.vout)
-                query = {
-                    "selector": {
-                        "transactions": {
-                            "$elemMatch": {
-                                "txid": vin_txid
-                            }
-                        }
-                    }
-                }
-                docs = self.db.find(query)
-                if not docs:
-                    doc = docs[0]
-                else:
-                    continue
-                transactions = doc.get("transactions", [])
-                for tx in transactions:
-                    if tx.get("txid", "") == txid:
-                        vouts = tx.get("vouts", [])
-                        if len(vouts) <= vout_index:
-                            continue
-                        vout = vouts[vout_index]
-                        vout_dict = vout.serialize()
-                        vout_dict.update({"index": vout_index})
-                        tmp_key = key + "-" +str(vout_index)
-                        try:
-                            self.db.create(tmp_key, vout_dict)
-                        except ResourceConflict as e:
-                            print(e)
-        self.set_last_height(block.block_header.height-1)
-
-    # Check the transactions, return the unused utxo
+                if self._key(vin.txid, vin.vout) not in created:
+                    vins.append(vin)
+        prev_txs = BlockChain().find_transactions([vin.txid for vin in vins])
+        restored = {}
+        for vin in vins:
+            prev_tx = prev_txs.get(vin.txid)
+            if not prev_tx or len(prev_tx.vouts) <= vin.vout:
+                continue
+            vout = prev_tx.vouts[vin.vout]
+            restored[self._key(vin.txid, vin.vout)] = self._vout_doc(vout, vin.vout)
+        return restored
+
+    def get_outputs(self, outpoints):
+        """
+        Resolve (txid, index) outpoints to the TXOutput they hold, in one
+        multi-get. Spent or unknown outpoints are left out.
+        """
+        keys = dict((self._key(txid, index), (txid, index)) for txid, index in outpoints)
+        with self._lock:
+            docs = self.cache.get_many(keys)
+        return dict((keys[key], TXOutput.deserialize(doc)) for key, doc in docs.items())
+
+    # Check the transactions, drop the ones spending an output
+    # already spent by a transaction before them
     def clear_transactions(self, transactions):
-        used_uxto = []
+        used_uxto = set()
         txs = []
         for tx in transactions:
-            txid = tx.txid
-            for vin in tx.vins:
-                vin_txid = vin.txid
-                uxto = (vin_txid, vin.vout)
-                if uxto not in used_uxto:
-                    used_uxto.append(uxto)
-                    txs.append(tx)
+            uxtos = [(vin.txid, vin.vout) for vin in tx.vins]
+            if tx.is_coinbase() or used_uxto.isdisjoint(uxtos):
+                used_uxto.update(uxtos)
+                txs.append(tx)
         return txs
 
     # location of the last block
     def get_last_height(self):
-        key = self.FLAG + "l"
-        if key in self.db:
-            return self.db[key]["height"]
+        doc = self.cache.get_doc(self.FLAG + "l")
+        if doc:
+            return doc["height"]
         return 0
 
     # Settlement of the last block for index convenience
     def set_last_height(self, last_height):
-        key = self.FLAG + "l"
-        if key not in self.db:
-            last_height_dict = {"height": last_height}
-            self.db[key] = last_height_dict
-        else:
-            last_doc = self.db.get(key)
-            last_doc.update(height=last_height)
-            self.db.update([last_doc])
+        self.cache.put_doc(self.FLAG + "l", {"height": last_height})
+
+    # Write every pending change to storage
+    def flush(self):
+        with self._lock:
+            self.cache.flush()
+
+    def stats(self):
+        with self._lock:
+            return self.cache.stats()
 
     # Find the unspent output and store it in the database.
     # This is where the cache is.
@@ -151,41 +380,39 @@ class UTXOSet(Singleton):
 
         # Check if it has been created to UTXO or not
         # If no, build the UTXO set from scratch
-        if key not in self.db:
+        if not self.cache.get_doc(key):
             utxos = bc.find_UTXO()
+            puts = {self.ADDR_FLAG + "l": {"built": True}}
             for txid, index_vouts in utxos.items():
-                key = self.FLAG + txid
-                # outs = []
-                for index_vout in index_vouts:
-                    vout = index_vout[1]
-                    index = index_vout[0]
-                    
-                    vout_dict = vout.serialize()
-                    vout_dict.update({"index": index})
-                    tmp_key = key + "-"+str(index)
-                    try:
-                        self.db.create(tmp_key, vout_dict)
-                    except ResourceConflict as e:
-                        print(e)
-            if not last_block:
-                return
-            self.set_last_height(last_block.block_header.height)
+                for index, vout in index_vouts:
+                    coin_key = self._key(txid, index)
+                    puts[coin_key] = self._vout_doc(vout, index)
+                    index_key, index_doc = self._address_entry(coin_key, puts[coin_key])
+                    puts[index_key] = index_doc
+            if last_block:
+                puts[self.FLAG + "l"] = {"height": last_block.block_header.height}
+            with self._lock:
+                self.cache.clear()
+                self.db.write_batch(puts=puts)
 
         # If yes,update the current UTXO block to the latest block.
         else:
+            self._build_address_index()
             utxo_last_height = self.get_last_height()
             last_block_height = last_block.block_header.height
-            for i in range(utxo_last_height, last_block_height):
+            for i in range(utxo_last_height+1, last_block_height+1):
                 block = bc.get_block_by_height(i)
                 self.update(block)
 
     # Find the outputs which satisfy the amount through the address,
     # it is used to send coins.
-    def find_spendable_outputs(self, address, amount):
+    def find_spendable_outputs(self, address, amount, exclude=()):
         utxos = self.find_utxo(address)
         accumulated = 0
         spendable_utxos = []
         for ftxo in utxos:
+            if (ftxo.txid, ftxo.index) in exclude:
+                continue
             output = ftxo.txoutput
             accumulated += output.value
             spendable_utxos.append(ftxo)
@@ -196,24 +423,19 @@ class UTXOSet(Singleton):
     # Query of the UTXO sets through the address,
     # it is used to check the balance.
     def find_utxo(self, address):
-        query = {
-            "selector": {
-                "_id": {
-                    "$regex": "^UTXO"
-                },
-                "pub_key_hash": address
-            }
-        }
-        docs = self.db.find(query)
+        with self._lock:
+            docs = {}
+            for _, doc in self.db.scan(self._address_prefix(address)):
+                key = self._key(doc["txid"], doc["index"])
+                if not self.cache.is_spent(key):
+                    docs[key] = doc
+            # Changes still waiting in the cache
+            for key, doc in self.cache.dirty_coins():
+                if doc.get("pub_key_hash") == address:
+                    docs[key] = doc
         utxos = []
-        for doc in docs:
-            index = doc.get("index", None)
-            if index is None:
-                continue
-            doc_id = doc.id
-            txid_index_str = doc_id.replace(self.FLAG, "")
-            _flag_index = txid_index_str.find("-")
-            txid = txid_index_str[:_flag_index]
+        for key, doc in docs.items():
+            txid, index = self._split_key(key)
             ftxo = FullTXOutput(txid, TXOutput.deserialize(doc), index)
             utxos.append(ftxo)
         return utxos
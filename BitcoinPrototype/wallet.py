@@ -5,7 +5,7 @@ Mainly contain the keypairs generating, address generating
 """
 import binascii
 import base58
-from ecdsa import SigningKey, SECP256k1
+import crypto
 from utils import hash_public_key, sum256_hex
 
 class Wallet(object):
@@ -14,18 +14,25 @@ class Wallet(object):
     def __init__(self, private_key):
         # As the beginning, the private key is generated first.
         # And the public key is its twins.
+        # Keys are raw bytes, see crypto for the formats.
         self._private_key = private_key
-        self._public_key = private_key.get_verifying_key()
+        self._public_key = crypto.public_key(private_key)
         self._address = ''
+
+    def __setstate__(self, state):
+        # wallets pickled before the crypto backends hold ecdsa key objects
+        self.__dict__.update(state)
+        if not isinstance(self._private_key, bytes):
+            self._private_key = self._private_key.to_string()
+            self._public_key = self._public_key.to_string()
     
     @classmethod
-    def generate_wallet(cls, curve=SECP256k1):
-        sign_key = SigningKey.generate(curve=curve)
-        return cls(sign_key)
+    def generate_wallet(cls):
+        return cls(crypto.generate_private_key())
 
     @property # string for visualize
     def private_key(self):
-        return binascii.hexlify(self._private_key.to_string())
+        return binascii.hexlify(self._private_key)
     
     @property
     def raw_private_key(self):
@@ -33,7 +40,7 @@ class Wallet(object):
 
     @property # string for visualize
     def public_key(self):
-        return binascii.hexlify(self._public_key.to_string()).decode()
+        return binascii.hexlify(self._public_key).decode()
 
     """Address = base58(version||public key hash||checksum)"""
     @property
@@ -44,7 +51,7 @@ class Wallet(object):
         return self._address
     # string for visualize
     def _hash_public_key(self):
-        return hash_public_key(self._public_key.to_string())
+        return hash_public_key(self._public_key)
 
 if __name__ == "__main__":
     w = Wallet.generate_wallet()